@@ -34,7 +34,13 @@ def get_daily_area_lengths(
                 mode_id,
                 trip_id,
                 ST_Transform(
-                    (SELECT ST_MakeLine(loc ORDER BY time) FROM {LOC_TABLE} WHERE {LOC_TABLE}.leg_id = {LEG_TABLE}.id),
+                    COALESCE(
+                        {LEG_TABLE}.geometry,
+                        (
+                            SELECT ST_MakeLine(loc ORDER BY time) FROM {LOC_TABLE}
+                            WHERE {LOC_TABLE}.leg_id = {LEG_TABLE}.id
+                        )
+                    ),
                     {LOCAL_SRS}
                 ) AS line
             FROM {LEG_TABLE}
@@ -1,8 +1,11 @@
+from functools import lru_cache
+
 import numpy as np
-from .dragfilter import DragFilter
+from .dragfilter import DragFilter, Fd, Qd, float_eps
 from .IMM import IMMEstimator
 from scipy.linalg import expm
 import numba
+from numba import njit, prange
 
 # Just some very uninformative priors,
 # the mean is somewhere around central Tampere.
@@ -25,13 +28,16 @@ def get_filter(force, drag):
     # doesn't matter.
     return lambda: DragFilter(force, drag, np.copy(m0), np.copy(S0))
 
-# Median matched to speeds
-filters = {
-    'still': get_filter(0.5, 1.0),
-    'walking': get_filter(2.0, 0.6),
-    'cycling': get_filter(3.0, 0.06),
-    'driving': get_filter(3.5, 0.008),
+# Median matched to speeds, (force, drag) per mode
+filter_params = {
+    'still': (0.5, 1.0),
+    'walking': (2.0, 0.6),
+    'cycling': (3.0, 0.06),
+    'driving': (3.5, 0.008),
 }
+filters = {mode: get_filter(force, drag) for mode, (force, drag) in filter_params.items()}
+filter_forces = np.array([force for force, drag in filter_params.values()])
+filter_drags = np.array([drag for force, drag in filter_params.values()])
 
 # Just some stetson-harrisons
 """
@@ -56,42 +62,631 @@ mean_state_duration = 5*60
 transition_rate = np.zeros((N_states, N_states)) + (1/mean_state_duration)/(N_states - 1)
 transition_rate[np.diag_indices(N_states)] = -1/mean_state_duration
 
+
+@njit(cache=True)
+def uniform_transition_matrices(dts, rate, n_states):
+    """Closed-form expm(Q*dt) for a rate matrix Q with all off-diagonals equal to `rate`.
+
+    Such Q is rate*n_states*(P - I) with P = ones/n_states a projection, so
+    expm(Q*dt) = e*I + (1 - e)*P, where e = exp(-rate*n_states*dt).
+    """
+    Ms = np.empty((len(dts), n_states, n_states))
+    for i in range(len(dts)):
+        e = np.exp(-rate * n_states * dts[i])
+        off_diagonal = (1 - e) / n_states
+        for j in range(n_states):
+            for k in range(n_states):
+                Ms[i, j, k] = off_diagonal
+            Ms[i, j, j] = e + off_diagonal
+    return Ms
+
+
+class TransitionMatrices:
+    """Provides the mode transition matrices expm(rate*dt) for time steps.
+
+    If all the off-diagonal rates are equal (and the rows sum to zero),
+    the matrices are computed exactly in closed form. Otherwise dt is
+    rounded to `dt_quantum` seconds and the matrices are computed with
+    expm() and kept in an LRU cache.
+    """
+
+    def __init__(self, rate, dt_quantum=0.5, cache_size=1024):
+        self.rate = np.array(rate, dtype=np.float64)
+        self.n_states = len(self.rate)
+        self.dt_quantum = dt_quantum
+        self.uniform_rate = self._get_uniform_rate(self.rate)
+        self._cached_expm = lru_cache(maxsize=cache_size)(self._compute_quantized)
+
+    @staticmethod
+    def _get_uniform_rate(rate):
+        off_diagonal = rate[~np.eye(len(rate), dtype=bool)]
+        if not len(off_diagonal) or not np.all(off_diagonal == off_diagonal[0]):
+            return None
+        if not np.allclose(rate.sum(axis=1), 0):
+            return None
+        return float(off_diagonal[0])
+
+    def _compute_quantized(self, steps):
+        M = expm(self.rate * (steps * self.dt_quantum))
+        M.flags.writeable = False
+        return M
+
+    def get(self, dt):
+        return self.get_many(np.array([dt], dtype=np.float64))[0]
+
+    def get_many(self, dts):
+        """Return an array of transition matrices, one for each dt in `dts`."""
+        dts = np.asarray(dts, dtype=np.float64)
+        if self.uniform_rate is not None:
+            return uniform_transition_matrices(dts, self.uniform_rate, self.n_states)
+
+        steps = np.round(dts / self.dt_quantum).astype(np.int64)
+        unique_steps, inverse = np.unique(steps, return_inverse=True)
+        Ms = np.empty((len(unique_steps), self.n_states, self.n_states))
+        for i, step in enumerate(unique_steps):
+            Ms[i] = self._cached_expm(int(step))
+        return Ms[inverse.reshape(-1)]
+
+
+transition_matrices = TransitionMatrices(transition_rate)
+
 def filter_trajectory(traj):
-    # TODO: Smoothing!
+    """Filter an iterable of samples with time, x, y, location_std, atype,
+    aconf and vehicle_way_distance attributes.
+
+    See filter_trajectory_arrays() for the faster array-based version.
+    """
+    traj = list(traj)
+    return filter_trajectory_arrays(
+        time=np.array([z.time for z in traj], dtype=np.float64),
+        x=np.array([z.x for z in traj], dtype=np.float64),
+        y=np.array([z.y for z in traj], dtype=np.float64),
+        location_std=np.array([z.location_std for z in traj], dtype=np.float64),
+        atype=np.array([filter_idx[z.atype] if z.atype is not None else -1 for z in traj], dtype=np.int64),
+        aconf=np.array([z.aconf for z in traj], dtype=np.float64),
+        vehicle_way_distance=np.array([z.vehicle_way_distance for z in traj], dtype=np.float64),
+    )
+
+
+def get_state_prob_ests(atype, aconf, location_std, vehicle_way_distance):
+    """Compute the "external" state probability estimates for all samples.
+
+    `atype` is the index of the estimated mode in `filters` (-1 for no
+    estimate) and `aconf` its confidence. Returns an (N, N_states) array.
+    """
+    n = len(atype)
+    state_prob_ests = np.ones((n, N_states))
+    has_atype = atype >= 0
+    leftover_prob = (1 - aconf[has_atype])/(N_states - 1)
+    state_prob_ests[has_atype] = leftover_prob[:, np.newaxis]
+    state_prob_ests[has_atype, atype[has_atype]] = aconf[has_atype]
+
+    # Compute "GIS" probability of being on a vehicle way.
+    # TODO! MEGASUPER HACKY 🤢!! We have nice distribution assupmptions and
+    # could to this in a lot more pricinpled manner using Rayleigh-distribution,
+    # but probably doesn't matter much here. So just double the "in_vehicle"
+    # class prob est if this would be an "outlier"
+    VEHICLE_GIS_PROB_FACTOR = 2
+    on_vehicle_way = vehicle_way_distance < 2*location_std
+    state_prob_ests[on_vehicle_way, -1] *= VEHICLE_GIS_PROB_FACTOR
+    state_prob_ests[~on_vehicle_way, -1] /= VEHICLE_GIS_PROB_FACTOR
+
+    state_prob_ests /= np.sum(state_prob_ests, axis=1)[:, np.newaxis]
+    return state_prob_ests
+
+
+class FilterState:
+    """Checkpoint of the IMM filter bank and the Viterbi frontier.
+
+    Passing a FilterState to filter_trajectory_arrays() continues filtering
+    from where the previous call left off, and the state is updated in place
+    to the last sample. A new FilterState starts from the uninformative prior.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # Time of the last filtered sample, None if nothing is filtered yet
+        self.time = None
+        # Mean and covariance of each filter
+        self.means = np.tile(m0, (N_states, 1))
+        self.covs = np.tile(S0, (N_states, 1, 1))
+        # TODO: Could use some global average. Probably doesn't matter
+        self.mode_probs = np.ones(N_states) / N_states
+        # Predicted mode probabilities and mixing probabilities for the next
+        # step. The first step doesn't mix the states.
+        self.mode_probs_pred = self.mode_probs.copy()
+        self.mixing_probs = np.eye(N_states)
+        # Viterbi path log-probabilities of the states at the last sample
+        self.path_logprobs = None
+
+    def to_dict(self):
+        """Return the state in a JSON serializable form."""
+        return dict(
+            time=self.time,
+            means=self.means.tolist(),
+            covs=self.covs.tolist(),
+            mode_probs=self.mode_probs.tolist(),
+            mode_probs_pred=self.mode_probs_pred.tolist(),
+            mixing_probs=self.mixing_probs.tolist(),
+            path_logprobs=self.path_logprobs.tolist() if self.path_logprobs is not None else None,
+        )
+
+    def copy(self):
+        return FilterState.from_dict(self.to_dict())
+
+    @classmethod
+    def from_dict(cls, data):
+        state = cls()
+        state.time = data['time']
+        for attr in ('means', 'covs', 'mode_probs', 'mode_probs_pred', 'mixing_probs'):
+            setattr(state, attr, np.array(data[attr], dtype=np.float64))
+        if data['path_logprobs'] is not None:
+            state.path_logprobs = np.array(data['path_logprobs'], dtype=np.float64)
+        return state
+
+
+@njit(cache=True)
+def imm_filter(
+    time, x, y, R_std, state_prob_ests, Ms, forces, drags, prev_time, fxs, fPs, mu, cbar, omega,
+    mode_means, mode_covs
+):
+    """Run the IMM filter bank over a whole trajectory.
+
+    Compiled version of running IMMEstimator with DragFilters; see
+    filter_trajectory_reference(). `Ms` holds the mode transition matrix
+    for each sample. The filter state (`fxs`, `fPs`, `mu`, `cbar` and
+    `omega`; see FilterState) is updated in place. If `mode_means` and
+    `mode_covs` are not empty, the posterior of each filter is stored in
+    them for every sample.
+
+    Returns (ms, Ss, state_probs, total_loglikelihood).
+    """
+    n = len(time)
+    n_states = len(forces)
+    ms = np.empty((n, 4))
+    Ss = np.empty((n, 4, 4))
+    state_probs = np.empty((n, n_states))
+    total_loglikelihood = 0.0
+
+    mixed_xs = np.empty((n_states, 4))
+    mixed_Ps = np.empty((n_states, 4, 4))
+    likelihood = np.empty(n_states)
+    K = np.empty((4, 2))
+    I_KH = np.empty((4, 4))
+    tmp = np.empty((4, 4))
+
+    for i in range(n):
+        dt = time[i] - prev_time
+        prev_time = time[i]
+        M = Ms[i]
+
+        # Predict: compute the mixed initial conditions and propagate them
+        for j in range(n_states):
+            for a in range(4):
+                mixed_xs[j, a] = 0.0
+                for k in range(n_states):
+                    mixed_xs[j, a] += fxs[k, a] * omega[k, j]
+            for a in range(4):
+                for b in range(4):
+                    mixed_Ps[j, a, b] = 0.0
+            for k in range(n_states):
+                w = omega[k, j]
+                for a in range(4):
+                    ya = fxs[k, a] - mixed_xs[j, a]
+                    for b in range(4):
+                        yb = fxs[k, b] - mixed_xs[j, b]
+                        mixed_Ps[j, a, b] += w * (ya * yb + fPs[k, a, b])
+
+        # Hack to avoid over/underflows: cap "effective" dt to 300 seconds
+        pred_dt = min(dt, 300.0)
+        for j in range(n_states):
+            F = Fd(pred_dt, forces[j], drags[j])
+            Q = Qd(pred_dt, forces[j], drags[j])
+            fx = mixed_xs[j]
+            fP = mixed_Ps[j]
+            for a in range(4):
+                fxs[j, a] = 0.0
+                for b in range(4):
+                    fxs[j, a] += F[a, b] * fx[b]
+            for a in range(4):
+                for b in range(4):
+                    tmp[a, b] = 0.0
+                    for c in range(4):
+                        tmp[a, b] += F[a, c] * fP[c, b]
+            for a in range(4):
+                for b in range(4):
+                    v = Q[a, b]
+                    for c in range(4):
+                        v += tmp[a, c] * F[b, c]
+                    fPs[j, a, b] = v
+
+        # Update
+        r = R_std[i]
+        if r <= 0:
+            # There are some negative values, just input something for them.
+            # Should be fixed at client end.
+            r = 100.0
+        r2 = r * r
+        for j in range(n_states):
+            cbar[j] *= state_prob_ests[i, j]
+
+        for j in range(n_states):
+            fx = fxs[j]
+            fP = fPs[j]
+            # Innovation covariance S = H P H' + R and its inverse
+            s00 = fP[0, 0] + r2
+            s01 = fP[0, 1]
+            s10 = fP[1, 0]
+            s11 = fP[1, 1] + r2
+            det = s00 * s11 - s01 * s10
+            i00 = s11 / det
+            i01 = -s01 / det
+            i10 = -s10 / det
+            i11 = s00 / det
+            res0 = x[i] - fx[0]
+            res1 = y[i] - fx[1]
+            maha = res0 * (i00 * res0 + i01 * res1) + res1 * (i10 * res0 + i11 * res1)
+            loglik = -0.5 * (2 * np.log(2 * np.pi) + maha + np.log(det))
+            likelihood[j] = max(np.exp(loglik), float_eps)
+
+            # Kalman gain K = P H' S^-1
+            for a in range(4):
+                K[a, 0] = fP[a, 0] * i00 + fP[a, 1] * i10
+                K[a, 1] = fP[a, 0] * i01 + fP[a, 1] * i11
+            for a in range(4):
+                fx[a] += K[a, 0] * res0 + K[a, 1] * res1
+
+            # Joseph form: P = (I-KH)P(I-KH)' + KRK'
+            for a in range(4):
+                for b in range(4):
+                    I_KH[a, b] = 1.0 if a == b else 0.0
+                I_KH[a, 0] -= K[a, 0]
+                I_KH[a, 1] -= K[a, 1]
+            for a in range(4):
+                for b in range(4):
+                    tmp[a, b] = 0.0
+                    for c in range(4):
+                        tmp[a, b] += I_KH[a, c] * fP[c, b]
+            for a in range(4):
+                for b in range(4):
+                    v = r2 * (K[a, 0] * K[b, 0] + K[a, 1] * K[b, 1])
+                    for c in range(4):
+                        v += tmp[a, c] * I_KH[b, c]
+                    fP[a, b] = v
+
+        # Mode probabilities from total probability * likelihood
+        weighted_likelihood = 0.0
+        for j in range(n_states):
+            mu[j] = cbar[j] * likelihood[j]
+            weighted_likelihood += mu[j]
+        for j in range(n_states):
+            mu[j] /= weighted_likelihood
+        total_loglikelihood += np.log(weighted_likelihood)
+
+        # Mixing probabilities for the next step
+        for j in range(n_states):
+            cbar[j] = 0.0
+            for k in range(n_states):
+                cbar[j] += mu[k] * M[k, j]
+        for k in range(n_states):
+            for j in range(n_states):
+                omega[k, j] = (M[k, j] * mu[k]) / cbar[j]
+
+        # Combined state estimate
+        for a in range(4):
+            v = 0.0
+            for j in range(n_states):
+                v += fxs[j, a] * mu[j]
+            ms[i, a] = v
+        for a in range(4):
+            for b in range(4):
+                v = 0.0
+                for j in range(n_states):
+                    v += mu[j] * ((fxs[j, a] - ms[i, a]) * (fxs[j, b] - ms[i, b]) + fPs[j, a, b])
+                Ss[i, a, b] = v
+        state_probs[i] = mu
+        if len(mode_means):
+            mode_means[i] = fxs
+            mode_covs[i] = fPs
+
+    return ms, Ss, state_probs, total_loglikelihood
+
+
+@njit(cache=True)
+def invert(A, out, work):
+    """Invert a small square matrix with Gauss-Jordan elimination."""
+    n = len(A)
+    for a in range(n):
+        for b in range(n):
+            work[a, b] = A[a, b]
+            out[a, b] = 1.0 if a == b else 0.0
+    for c in range(n):
+        pivot = c
+        for r in range(c + 1, n):
+            if abs(work[r, c]) > abs(work[pivot, c]):
+                pivot = r
+        if pivot != c:
+            for b in range(n):
+                work[c, b], work[pivot, b] = work[pivot, b], work[c, b]
+                out[c, b], out[pivot, b] = out[pivot, b], out[c, b]
+        d = work[c, c]
+        for b in range(n):
+            work[c, b] /= d
+            out[c, b] /= d
+        for r in range(n):
+            if r == c:
+                continue
+            f = work[r, c]
+            if f == 0.0:
+                continue
+            for b in range(n):
+                work[r, b] -= f * work[c, b]
+                out[r, b] -= f * out[c, b]
+
+
+@njit(cache=True)
+def rts_smooth(time, mode_means, mode_covs, state_probs, forces, drags):
+    """Rauch-Tung-Striebel smoothing of the IMM filter output.
+
+    Runs a backward sweep for each filter over its own posteriors and
+    combines the smoothed estimates with the (filtered) mode probabilities.
+    This ignores the mode switches within the sweep, so it's an
+    approximation of proper IMM smoothing.
+
+    Returns the smoothed (ms, Ss).
+    """
+    n = len(time)
+    n_states = len(forces)
+    smoothed_means = mode_means.copy()
+    smoothed_covs = mode_covs.copy()
+    x_pred = np.empty(4)
+    P_pred = np.empty((4, 4))
+    tmp = np.empty((4, 4))
+    C = np.empty((4, 4))
+    P_pred_inv = np.empty((4, 4))
+    work = np.empty((4, 4))
+
+    for i in range(n - 2, -1, -1):
+        # Same cap for the effective dt as in the prediction
+        dt = min(time[i + 1] - time[i], 300.0)
+        for j in range(n_states):
+            F = Fd(dt, forces[j], drags[j])
+            Q = Qd(dt, forces[j], drags[j])
+            fx = mode_means[i, j]
+            fP = mode_covs[i, j]
+            for a in range(4):
+                x_pred[a] = 0.0
+                for b in range(4):
+                    x_pred[a] += F[a, b] * fx[b]
+            # tmp = P F'
+            for a in range(4):
+                for b in range(4):
+                    tmp[a, b] = 0.0
+                    for c in range(4):
+                        tmp[a, b] += fP[a, c] * F[b, c]
+            for a in range(4):
+                for b in range(4):
+                    v = Q[a, b]
+                    for c in range(4):
+                        v += F[a, c] * tmp[c, b]
+                    P_pred[a, b] = v
+            # Smoother gain C = P F' P_pred^-1
+            invert(P_pred, P_pred_inv, work)
+            for a in range(4):
+                for b in range(4):
+                    v = 0.0
+                    for c in range(4):
+                        v += tmp[a, c] * P_pred_inv[c, b]
+                    C[a, b] = v
+
+            sx = smoothed_means[i, j]
+            sP = smoothed_covs[i, j]
+            next_sx = smoothed_means[i + 1, j]
+            next_sP = smoothed_covs[i + 1, j]
+            for a in range(4):
+                for b in range(4):
+                    sx[a] += C[a, b] * (next_sx[b] - x_pred[b])
+            # P_s = P + C (P_s_next - P_pred) C'
+            for a in range(4):
+                for b in range(4):
+                    tmp[a, b] = 0.0
+                    for c in range(4):
+                        tmp[a, b] += C[a, c] * (next_sP[c, b] - P_pred[c, b])
+            for a in range(4):
+                for b in range(4):
+                    v = 0.0
+                    for c in range(4):
+                        v += tmp[a, c] * C[b, c]
+                    sP[a, b] += v
+
+    ms = np.zeros((n, 4))
+    Ss = np.zeros((n, 4, 4))
+    for i in range(n):
+        for j in range(n_states):
+            for a in range(4):
+                ms[i, a] += state_probs[i, j] * smoothed_means[i, j, a]
+        for j in range(n_states):
+            for a in range(4):
+                ya = smoothed_means[i, j, a] - ms[i, a]
+                for b in range(4):
+                    yb = smoothed_means[i, j, b] - ms[i, b]
+                    Ss[i, a, b] += state_probs[i, j] * (ya * yb + smoothed_covs[i, j, a, b])
+
+    return ms, Ss
+
+
+def filter_trajectory_arrays(
+    time, x, y, location_std, atype, aconf, vehicle_way_distance, state=None, smooth=False
+):
+    """Filter a trajectory given as contiguous arrays of equal length.
+
+    `time` is in seconds, `x` and `y` in the local 2D CRS, `atype` the index
+    of the mode in `filters` (-1 for unknown) and `aconf` the confidence of
+    the mode estimate (0..1). If a FilterState is given as `state`, filtering
+    continues from it and it is updated to the last sample. If `smooth` is
+    true, the returned ms and Ss are smoothed with rts_smooth().
+
+    Returns (ms, Ss, state_probs, most_likely_path, total_loglikelihood).
+    """
+    if state is None:
+        state = FilterState()
+    time = np.ascontiguousarray(time, dtype=np.float64)
+    state_prob_ests = get_state_prob_ests(atype, aconf, location_std, vehicle_way_distance)
+    prev_time = state.time if state.time is not None else time[0]
+    Ms = transition_matrices.get_many(np.diff(time, prepend=prev_time))
+    if state.path_logprobs is None:
+        initial_logprobs = np.log(state.mode_probs)
+        continued = False
+    else:
+        # The path before the checkpoint is already decided, so continue
+        # from the frontier.
+        initial_logprobs = state.path_logprobs
+        continued = True
+
+    n = len(time) if smooth else 0
+    mode_means = np.empty((n, N_states, 4))
+    mode_covs = np.empty((n, N_states, 4, 4))
+    ms, Ss, state_probs, total_loglikelihood = imm_filter(
+        time, np.ascontiguousarray(x, dtype=np.float64), np.ascontiguousarray(y, dtype=np.float64),
+        np.ascontiguousarray(location_std, dtype=np.float64), state_prob_ests, Ms,
+        filter_forces, filter_drags, prev_time,
+        state.means, state.covs, state.mode_probs, state.mode_probs_pred, state.mixing_probs,
+        mode_means, mode_covs,
+    )
+    if smooth:
+        ms, Ss = rts_smooth(time, mode_means, mode_covs, state_probs, filter_forces, filter_drags)
+
+    # TODO FIXME: "Most likely path decoding" with IMM state probs. Theoretically HIDEOUS!
+    most_likely_path, state.path_logprobs = viterbi_frontier(initial_logprobs, Ms, state_probs, continued)
+    state.time = time[-1]
+
+    return ms, Ss, state_probs, most_likely_path, total_loglikelihood
+
+
+def _filter_batch(
+    time, x, y, R_std, state_prob_ests, Ms, offsets, forces, drags, m0, S0, initial_state_probs, smooth
+):
+    n = len(time)
+    n_states = len(forces)
+    ms = np.empty((n, 4))
+    Ss = np.empty((n, 4, 4))
+    state_probs = np.empty((n, n_states))
+    paths = np.empty(n, dtype=np.int64)
+    logliks = np.empty(len(offsets) - 1)
+
+    for k in prange(len(offsets) - 1):
+        start = offsets[k]
+        end = offsets[k + 1]
+        if start == end:
+            logliks[k] = 0.0
+            continue
+        fxs = np.empty((n_states, 4))
+        fPs = np.empty((n_states, 4, 4))
+        for j in range(n_states):
+            fxs[j] = m0
+            fPs[j] = S0
+        mu = initial_state_probs.copy()
+        cbar = mu.copy()
+        omega = np.eye(n_states)
+        n_kept = end - start if smooth else 0
+        mode_means = np.empty((n_kept, n_states, 4))
+        mode_covs = np.empty((n_kept, n_states, 4, 4))
+
+        t = time[start:end]
+        traj_ms, traj_Ss, traj_state_probs, loglik = imm_filter(
+            t, x[start:end], y[start:end], R_std[start:end], state_prob_ests[start:end], Ms[start:end],
+            forces, drags, t[0], fxs, fPs, mu, cbar, omega, mode_means, mode_covs,
+        )
+        if smooth:
+            traj_ms, traj_Ss = rts_smooth(t, mode_means, mode_covs, traj_state_probs, forces, drags)
+        path, _ = viterbi_frontier(np.log(initial_state_probs), Ms[start:end], traj_state_probs, False)
+
+        ms[start:end] = traj_ms
+        Ss[start:end] = traj_Ss
+        state_probs[start:end] = traj_state_probs
+        paths[start:end] = path
+        logliks[k] = loglik
+
+    return ms, Ss, state_probs, paths, logliks
+
+
+filter_batch = njit(cache=True)(_filter_batch)
+filter_batch_parallel = njit(cache=True, parallel=True)(_filter_batch)
+
+
+def filter_trajectories_arrays(
+    time, x, y, location_std, atype, aconf, vehicle_way_distance, offsets, smooth=False, parallel=False
+):
+    """Filter a batch of trajectories in one compiled call.
+
+    The trajectories are concatenated in the arrays (see
+    filter_trajectory_arrays()) and trajectory k is at
+    offsets[k]:offsets[k + 1]. Each trajectory is filtered from the prior,
+    with `parallel` in multiple threads.
+
+    Returns (ms, Ss, state_probs, most_likely_path, total_loglikelihoods),
+    the first four concatenated like the inputs.
+    """
+    time = np.ascontiguousarray(time, dtype=np.float64)
+    offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+    state_prob_ests = get_state_prob_ests(atype, aconf, location_std, vehicle_way_distance)
+    dts = np.diff(time, prepend=time[:1])
+    # The first sample of each trajectory doesn't have a predecessor
+    dts[offsets[:-1][offsets[:-1] < len(time)]] = 0.0
+    Ms = transition_matrices.get_many(dts)
+
+    func = filter_batch_parallel if parallel else filter_batch
+    return func(
+        time, np.ascontiguousarray(x, dtype=np.float64), np.ascontiguousarray(y, dtype=np.float64),
+        np.ascontiguousarray(location_std, dtype=np.float64), state_prob_ests, Ms, offsets,
+        filter_forces, filter_drags, m0, S0, np.ones(N_states) / N_states, smooth,
+    )
+
+
+def filter_trajectory_reference(time, x, y, location_std, atype, aconf, vehicle_way_distance):
+    """Pure Python version of filter_trajectory_arrays() using IMMEstimator.
+
+    Slow, but kept for verifying the compiled filter.
+    """
     filts = [f() for f in filters.values()]
     # TODO: Could use some global average. Probably doesn't matter
     state_probs = np.ones(N_states)
     state_probs /= np.sum(state_probs)
 
     initial_state_probs = np.copy(state_probs)
-    # The trellis with a less confusing name.
-    # Note that state_probs is different from path_probs.
-    # The latter refers to sort of "maximum likelihood attainable by selecting
-    # this state at this step". More or less standard Viterbi, but with the
-    # IMM observation probs. Breaking quite a few assumptions here probably, so
-    # not strictly optimal but probably works relatively well; IMM breaks them all already anyway.
-    path_probs = np.copy(state_probs)
-    most_likely_transitions = []
-    
+
     imm = IMMEstimator(filts, state_probs)
-    #imm = filts[-1] # HACK!
-    
-    ms = []
-    Ss = []
-    state_probs = []
-
-    prev_time = None
-    for z in traj:
-        if prev_time is None:
-            prev_time = z.time
-        dt = z.time - prev_time
-        prev_time = z.time
+
+    n = len(time)
+    ms = np.empty((n, 4))
+    Ss = np.empty((n, 4, 4))
+    Ms = np.empty((n, N_states, N_states))
+    state_probs = np.empty((n, N_states))
+
+    dts = np.diff(time, prepend=time[:1])
+
+    # Compute "external" predictions of the new state. We could fuse
+    # also e.g. MEMS derived predictions here too.
+    # TODO: Could really use the full prediction probability vector
+    # here!!
+    state_prob_ests = get_state_prob_ests(atype, aconf, location_std, vehicle_way_distance)
+
+    # There are some negative values, just input something for them.
+    # Should be fixed at client end.
+    R_std = np.where(location_std <= 0, 100.0, location_std)
+    measurements = np.column_stack((x, y))
+
+    for i in range(n):
+        dt = dts[i]
         # The transition matrix for this timestep. For some reason FilterPy has
         # this in the update step. I think it would be more logical in the prediction
         # step as this can be computed without any measurements. TODO: Verify FilterPy
         # implementation.
         M = expm(transition_rate*dt)
-        
+        Ms[i] = M
+
         with np.errstate(all="raise"):
             # Qd(dt) overflows when the dt is too high. Currently the Kalman filters
             # handle this. Would be nicer to handle here. Not sure what to do other
@@ -99,122 +694,90 @@ def filter_trajectory(traj):
             # make this cleaner.
             imm.predict(dt)
 
-        measurement = np.array([z.x, z.y])
-        
-        R = float(z.location_std)
-        if R <= 0:
-            # There are some negative values, just input something for them.
-            # Should be fixed at client end.
-            R = 100.0
-        
         # TODO: Check that this is correct. The location_std is the
         # 68% prob (ie std of) radius of the error
-        R = np.diag([R**2, R**2])
-        
-        # Compute "external" predictions of the new state. We could fuse
-        # also e.g. MEMS derived predictions here too.
-        # TODO: Could really use the full prediction probability vector
-        # here!!
-        # TODO: Is there more succint way of computing the full prob vector like this?
-
-        state_prob_ests = np.ones(N_states)
-        if z.atype is not None:
-            mode_state_prob = z.aconf
-            leftover_prob = (1 - mode_state_prob)/(N_states - 1)
-            state_prob_ests *= np.zeros(N_states) + leftover_prob
-            state_prob_ests[filter_idx[z.atype]] = mode_state_prob
-
-        # Compute "GIS" probability of being on a vehicle way.
-        # TODO! MEGASUPER HACKY 🤢!! We have nice distribution assupmptions and
-        # could to this in a lot more pricinpled manner using Rayleigh-distribution,
-        # but probably doesn't matter much here. So just double the "in_vehicle"
-        # class prob est if this would be an "outlier"
-        VEHICLE_GIS_PROB_FACTOR = 2
-        if z.vehicle_way_distance < 2*z.location_std:
-            state_prob_ests[-1] *= VEHICLE_GIS_PROB_FACTOR
-        else:
-            state_prob_ests[-1] /= VEHICLE_GIS_PROB_FACTOR
-        
-        state_prob_ests /= np.sum(state_prob_ests)
-        
+        R = np.diag([R_std[i]**2, R_std[i]**2])
+
         # TODO: Try to get the M into the prediction step. Mostly because
         # it feels wrong here.
-        imm.update(measurement, R, M, state_prob_ests=state_prob_ests)
-        ms.append(np.copy(imm.x))
-        Ss.append(np.copy(imm.P))
-        state_probs.append(np.copy(imm.mu))
-
-        # Compute the most likely path stuff
-        path_probs_new = np.empty_like(path_probs)
-        new_transitions = []
-        for new_mode_i in range(N_states):
-            best_prev_i = None
-            best_new_prob = -1
-            for prev_mode_i in range(len(filters)):
-                obs_lik = filts[new_mode_i].likelihood
-                new_prob = path_probs[prev_mode_i]*obs_lik*M[prev_mode_i,new_mode_i]
-                if new_prob > best_new_prob:
-                    best_new_prob = new_prob
-                    best_prev_i = prev_mode_i
-            path_probs_new[new_mode_i] = best_new_prob
-            new_transitions.append(best_prev_i)
-        path_probs = path_probs_new
-        path_probs /= np.sum(path_probs)
-        most_likely_transitions.append(new_transitions)
-    
-    state_probs = np.array(state_probs)
-
-    most_likely_state = np.argmax(path_probs)
-    most_likely_path = [most_likely_state]
-    for states in most_likely_transitions[::-1]:
-        most_likely_state = states[most_likely_state]
-        most_likely_path.append(most_likely_state)
-    
-    # TODO FIXME: This seems to be broken ATM! Fix or remove the duplicate viterbi-attempt
-    most_likely_path = most_likely_path[::-1][1:]
-
-    # TODO FIXME: Temporary hack as the viterbi is a bit buggy ATM
-    #most_likely_path = np.argmax(state_probs, axis=1)
-    
-    # TODO FIXME: Hack to do "most likely path decoding" with IMM state probs. Theoretically HIDEOUS!
-    # TODO FIXME: Known to cause problems that time-variant transition probs will fix easily!
-    HACK_FIXED_DT_TRANSITIONS = expm(transition_rate*5)
-    most_likely_path = viterbi(initial_state_probs, HACK_FIXED_DT_TRANSITIONS, state_probs)
-    most_likely_path = np.array(most_likely_path)
-    
-    return np.array(ms), np.array(Ss), state_probs, most_likely_path, imm.total_loglikelihood
+        imm.update(measurements[i], R, M, state_prob_ests=state_prob_ests[i])
+        ms[i] = imm.x
+        Ss[i] = imm.P
+        state_probs[i] = imm.mu
 
+    most_likely_path = viterbi(initial_state_probs, Ms, state_probs)
 
+    return ms, Ss, state_probs, most_likely_path, imm.total_loglikelihood
+
+
+@njit(cache=True)
 def safelog(x):
-    return np.log(np.clip(x, 1e-9, None))
+    return np.log(max(x, 1e-9))
 
-def viterbi(initial_probs, transition_probs, emissions):
+
+@njit(cache=True)
+def viterbi_frontier(initial_logprobs, transition_probs, emissions, continued):
+    """Decode the most likely state sequence in log space.
+
+    `transition_probs` holds the transition matrix for each step, the one
+    for step i being used for the transition from state i - 1 to i. If
+    `continued` is true, `initial_logprobs` is the frontier returned by a
+    previous call and the first step transitions from it; otherwise it is
+    the log prior of the first state.
+
+    Returns the state indexes and the frontier (path log-probabilities of
+    each state at the last step).
+    """
     # TODO: Online mode
-    # TODO: Variable dt transitions!!
-    n_states = len(initial_probs)
-    emissions = iter(emissions)
-    emission = next(emissions)
-    transition_probs = safelog(transition_probs)
-    probs = safelog(emission) + safelog(initial_probs)
-    state_stack = []
-    
-    for i, emission in enumerate(emissions):
-        total_prob = np.sum(emission)
-        if total_prob > 1e-9:
-            emission /= total_prob
-        else:
-            emission[:] = 1/len(emission)
-        trans_probs = transition_probs + np.row_stack(probs)
-        most_likely_states = np.argmax(trans_probs, axis=0)
-        probs = safelog(emission) + trans_probs[most_likely_states, np.arange(n_states)]
-        state_stack.append(most_likely_states)
-    
-    state_seq = [np.argmax(probs)]
-
-    while state_stack:
-        most_likely_states = state_stack.pop()
-        state_seq.append(most_likely_states[state_seq[-1]])
-
-    state_seq.reverse()
+    n, n_states = emissions.shape
+    state_seq = np.zeros(n, dtype=np.int64)
+    probs = initial_logprobs.copy()
+    if n == 0:
+        return state_seq, probs
+
+    new_probs = np.empty(n_states)
+    emission = np.empty(n_states)
+    state_stack = np.zeros((n, n_states), dtype=np.int64)
+
+    for i in range(n):
+        if i == 0 and not continued:
+            for j in range(n_states):
+                probs[j] = safelog(emissions[0, j]) + initial_logprobs[j]
+            continue
+        total_prob = np.sum(emissions[i])
+        for j in range(n_states):
+            if total_prob > 1e-9:
+                emission[j] = emissions[i, j] / total_prob
+            else:
+                emission[j] = 1 / n_states
+        for j in range(n_states):
+            best_prev = 0
+            best_prob = -np.inf
+            for k in range(n_states):
+                p = probs[k] + safelog(transition_probs[i, k, j])
+                if p > best_prob:
+                    best_prob = p
+                    best_prev = k
+            state_stack[i, j] = best_prev
+            new_probs[j] = safelog(emission[j]) + best_prob
+        probs[:] = new_probs
+
+    state_seq[n - 1] = np.argmax(probs)
+    for i in range(n - 1, 0, -1):
+        state_seq[i - 1] = state_stack[i, state_seq[i]]
+
+    # Only the differences matter, so keep the numbers small
+    probs -= np.max(probs)
+    return state_seq, probs
+
+
+def viterbi(initial_probs, transition_probs, emissions):
+    """Decode the most likely state sequence in log space.
 
+    `transition_probs` holds the transition matrix for each step, the one
+    for step i being used for the transition from state i - 1 to i.
+    Returns an integer array of state indexes.
+    """
+    initial_logprobs = np.log(np.clip(initial_probs, 1e-9, None))
+    state_seq, _ = viterbi_frontier(initial_logprobs, transition_probs, emissions, False)
     return state_seq
@@ -0,0 +1,253 @@
+import io
+import uuid
+
+import numpy as np
+import pandas as pd
+from numba import njit
+
+
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+# Microseconds between the Unix epoch and the PostgreSQL epoch (2000-01-01)
+PG_EPOCH_OFFSET_US = 946684800 * 1000000
+
+# Type names by PostgreSQL type OID
+PG_TYPES = {
+    16: 'bool',
+    17: 'bytea',
+    20: 'int8',
+    21: 'int2',
+    23: 'int4',
+    25: 'text',
+    700: 'float4',
+    701: 'float8',
+    1042: 'text',  # bpchar
+    1043: 'text',  # varchar
+    1114: 'timestamp',
+    1184: 'timestamptz',
+    1700: 'numeric',
+    2950: 'uuid',
+}
+FIXED_TYPES = {
+    'bool': '>u1',
+    'int2': '>i2',
+    'int4': '>i4',
+    'int8': '>i8',
+    'float4': '>f4',
+    'float8': '>f8',
+    'timestamp': '>i8',
+    'timestamptz': '>i8',
+}
+
+
+@njit(cache=True)
+def _read_int(buf, pos, size):
+    value = 0
+    for i in range(size):
+        value = (value << 8) | np.int64(buf[pos + i])
+    if value >= 1 << (size * 8 - 1):
+        value -= 1 << (size * 8)
+    return value
+
+
+@njit(cache=True)
+def _scan_tuples(buf, pos, n_fields):
+    # Every tuple takes at least the field count and the field lengths
+    max_rows = (len(buf) - pos) // (2 + 4 * n_fields) + 1
+    offsets = np.empty((max_rows, n_fields), dtype=np.int64)
+    lengths = np.empty((max_rows, n_fields), dtype=np.int64)
+    n = 0
+    while pos < len(buf):
+        count = _read_int(buf, pos, 2)
+        pos += 2
+        if count == -1:
+            break
+        if count != n_fields:
+            raise ValueError('Unexpected number of fields in tuple')
+        for j in range(n_fields):
+            length = _read_int(buf, pos, 4)
+            pos += 4
+            offsets[n, j] = pos
+            lengths[n, j] = length
+            if length > 0:
+                pos += length
+        n += 1
+    return offsets[:n], lengths[:n]
+
+
+def _decode_fixed(buf, offsets, is_null, type_name):
+    dtype = np.dtype(FIXED_TYPES[type_name])
+    # NULL fields have no data, so read something harmless for them
+    offsets = np.where(is_null, 0, offsets)
+    idx = offsets[:, None] + np.arange(dtype.itemsize)
+    values = buf[idx].view(dtype).ravel()
+    has_nulls = is_null.any()
+
+    if type_name in ('timestamp', 'timestamptz'):
+        values = (values.astype(np.int64) + PG_EPOCH_OFFSET_US).astype('datetime64[us]')
+        if has_nulls:
+            values[is_null] = np.datetime64('NaT')
+        values = pd.to_datetime(values)
+        if type_name == 'timestamptz':
+            values = values.tz_localize('UTC')
+        return values
+    if type_name == 'bool':
+        values = values.astype(bool)
+        if has_nulls:
+            values = values.astype(object)
+            values[is_null] = None
+        return values
+    if type_name.startswith('int') and not has_nulls:
+        return values.astype(np.int64)
+    values = values.astype(np.float64)
+    if has_nulls:
+        values[is_null] = np.nan
+    return values
+
+
+@njit(cache=True)
+def _gather_bytes(buf, offsets, lengths, width):
+    out = np.zeros((len(offsets), width), dtype=np.uint8)
+    for i in range(len(offsets)):
+        for k in range(lengths[i]):
+            out[i, k] = buf[offsets[i] + k]
+    return out
+
+
+def _decode_text(buf, offsets, lengths):
+    is_null = lengths < 0
+    width = max(int(lengths.max(initial=0)), 1)
+    # Values repeat a lot (activity types, way ids), so decode only the
+    # distinct ones. PostgreSQL text never contains NUL bytes, so the
+    # padding of the fixed-width strings is unambiguous.
+    strings = _gather_bytes(buf, offsets, np.maximum(lengths, 0), width).view('S%d' % width).ravel()
+    distinct, inverse = np.unique(strings, return_inverse=True)
+    decoded = np.array([str(b, 'utf-8') for b in distinct] + [None], dtype=object)
+    inverse = inverse.ravel()
+    inverse[is_null] = len(distinct)
+    return decoded[inverse]
+
+
+def _decode_binary(data, offsets, lengths, type_name):
+    values = np.empty(len(offsets), dtype=object)
+    for i, (offset, length) in enumerate(zip(offsets.tolist(), lengths.tolist())):
+        if length < 0:
+            values[i] = None
+            continue
+        value = bytes(data[offset:offset + length])
+        values[i] = str(uuid.UUID(bytes=value)) if type_name == 'uuid' else value
+    return values
+
+
+def decode_copy_binary(data, columns):
+    """Decode the output of COPY ... TO STDOUT (FORMAT binary) into a DataFrame.
+
+    `columns` is a list of (name, type name) pairs, the type names being
+    the values of PG_TYPES. Integer columns with NULLs become floats.
+    """
+    data = memoryview(data)
+    if bytes(data[:len(COPY_SIGNATURE)]) != COPY_SIGNATURE:
+        raise ValueError('Not in PostgreSQL binary COPY format')
+    buf = np.frombuffer(data, dtype=np.uint8)
+    pos = len(COPY_SIGNATURE) + 4
+    pos += 4 + _read_int(buf, pos, 4)  # header extension
+
+    offsets, lengths = _scan_tuples(buf, pos, len(columns))
+    out = {}
+    for j, (name, type_name) in enumerate(columns):
+        if type_name == 'numeric':
+            raise ValueError('Column %s is numeric, cast it to float8 in the query' % name)
+        if type_name in FIXED_TYPES:
+            out[name] = _decode_fixed(buf, offsets[:, j], lengths[:, j] < 0, type_name)
+        elif type_name in ('uuid', 'bytea'):
+            out[name] = _decode_binary(data, offsets[:, j], lengths[:, j], type_name)
+        else:
+            out[name] = _decode_text(buf, offsets[:, j], lengths[:, j])
+    return pd.DataFrame(out, columns=[name for name, _ in columns])
+
+
+# Result columns of the queries by query text. The binary COPY output has no
+# type information and psycopg2 can't describe a statement without running
+# it, so every query is described only once per process.
+_query_columns = {}
+
+
+def _describe_query(curs, query):
+    curs.execute('SELECT * FROM (%s) AS q LIMIT 0' % query)
+    columns = []
+    for col in curs.description:
+        if col.type_code not in PG_TYPES:
+            raise ValueError('Column %s has an unsupported type (oid %d)' % (col.name, col.type_code))
+        columns.append((col.name, PG_TYPES[col.type_code]))
+    return columns
+
+
+def read_sql_frame(conn, query, params=None, columns=None):
+    """Run a query and return the result as a DataFrame of typed columns.
+
+    Works like pd.read_sql_query(), but the rows are transferred with
+    binary COPY and decoded straight into NumPy arrays. The result columns
+    are given as (name, type name) pairs in `columns`, or looked up the
+    first time the query is run.
+    """
+    with conn.cursor() as curs:
+        sql = curs.mogrify(query, params).decode('utf-8')
+        if columns is None:
+            columns = _query_columns.get(query)
+        if columns is None:
+            columns = _describe_query(curs, sql)
+            _query_columns[query] = columns
+
+        out = io.BytesIO()
+        curs.copy_expert('COPY (%s) TO STDOUT (FORMAT binary)' % sql, out)
+    return decode_copy_binary(out.getbuffer(), columns)
+
+
+# EWKB header of a little-endian 2D point with an SRID
+EWKB_POINT_WITH_SRID = 0x20000001
+
+
+def _timestamps_to_pg(values):
+    values = pd.Series(values)
+    if values.dt.tz is not None:
+        values = values.dt.tz_convert(None)
+    return values.to_numpy(dtype='datetime64[us]').astype(np.int64) - PG_EPOCH_OFFSET_US
+
+
+def encode_copy_binary(columns):
+    """Encode columns for COPY ... FROM STDIN (FORMAT binary).
+
+    `columns` is a list of (type name, values) pairs with types 'int4',
+    'int8', 'float8' or 'timestamptz', or ('point', (x, y, srid)) for
+    PostGIS point geometries. The types have to match the columns of the
+    target table exactly. NULLs are not supported.
+    """
+    fields = [('count', '>i2')]
+    values = {}
+    for i, (type_name, col) in enumerate(columns):
+        name = 'f%d' % i
+        if type_name == 'point':
+            x, y, srid = col
+            n = len(x)
+            fields += [
+                (name + '_len', '>i4'), (name + '_order', 'u1'), (name + '_type', '<u4'),
+                (name + '_srid', '<u4'), (name + '_x', '<f8'), (name + '_y', '<f8'),
+            ]
+            values.update({
+                name + '_len': 25, name + '_order': 1, name + '_type': EWKB_POINT_WITH_SRID,
+                name + '_srid': srid, name + '_x': x, name + '_y': y,
+            })
+            continue
+        if type_name == 'timestamptz':
+            col = _timestamps_to_pg(col)
+        n = len(col)
+        dtype = np.dtype(FIXED_TYPES[type_name])
+        fields += [(name + '_len', '>i4'), (name, dtype)]
+        values.update({name + '_len': dtype.itemsize, name: col})
+
+    tuples = np.empty(n, dtype=np.dtype(fields))
+    tuples['count'] = len(columns)
+    for name, col in values.items():
+        tuples[name] = col
+    header = COPY_SIGNATURE + np.array([0, 0], dtype='>i4').tobytes()
+    trailer = np.array([-1], dtype='>i2').tobytes()
+    return header + tuples.tobytes() + trailer
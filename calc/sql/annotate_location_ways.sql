@@ -0,0 +1,47 @@
+-- Store the nearest car and rail ways (within 50 m) of the location samples
+-- that don't have them yet, the same way as EventProcessor.insert_locations()
+-- does for new samples. Used by the annotate_location_ways command.
+PREPARE annotate_location_ways (uuid, timestamp with time zone, timestamp with time zone) AS
+UPDATE trips_ingest_location AS l
+SET
+    closest_car_way_id = a.closest_car_way_id,
+    closest_car_way_dist = a.closest_car_way_dist,
+    closest_rail_way_id = a.closest_rail_way_id,
+    closest_rail_way_dist = a.closest_rail_way_dist,
+    closest_ways_updated_at = NOW()
+FROM (
+    SELECT
+        l2.time,
+        l2.uuid,
+        ccw.osm_id AS closest_car_way_id,
+        ST_Distance(ccw.way, l2.loc) AS closest_car_way_dist,
+        crw.osm_id AS closest_rail_way_id,
+        ST_Distance(crw.way, l2.loc) AS closest_rail_way_dist
+    FROM
+        trips_ingest_location AS l2
+    LEFT JOIN LATERAL (
+        SELECT osm_id, way
+        FROM planet_osm_car_ways AS cw
+        WHERE
+            cw.way && ST_Expand(l2.loc, 50)
+        ORDER BY cw.way <-> l2.loc
+        LIMIT 1
+    ) AS ccw ON true
+    LEFT JOIN LATERAL (
+        SELECT osm_id, way
+        FROM planet_osm_rail_ways AS rw
+        WHERE
+            rw.way && ST_Expand(l2.loc, 50)
+        ORDER BY rw.way <-> l2.loc
+        LIMIT 1
+    ) AS crw ON true
+    WHERE
+        l2.uuid = $1
+        AND l2.time >= $2
+        AND l2.time <= $3
+        AND l2.deleted_at IS NULL
+        AND l2.closest_ways_updated_at IS NULL
+) AS a
+WHERE
+    l.uuid = a.uuid
+    AND l.time = a.time;
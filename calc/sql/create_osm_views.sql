@@ -22,6 +22,9 @@ CREATE INDEX planet_osm_car_ways_geom_idx
   ON planet_osm_car_ways
   USING GIST (way);
 
+CREATE INDEX planet_osm_car_ways_osm_id_idx
+  ON planet_osm_car_ways (osm_id);
+
 
 CREATE MATERIALIZED VIEW IF NOT EXISTS planet_osm_transit_routes AS
     SELECT
@@ -56,3 +59,6 @@ CREATE MATERIALIZED VIEW IF NOT EXISTS planet_osm_rail_ways AS
 CREATE INDEX planet_osm_rail_ways_geom_idx
   ON planet_osm_rail_ways
   USING GIST (way);
+
+CREATE INDEX planet_osm_rail_ways_osm_id_idx
+  ON planet_osm_rail_ways (osm_id);
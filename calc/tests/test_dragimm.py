@@ -0,0 +1,158 @@
+import itertools
+import json
+
+import numpy as np
+import pytest
+from scipy.linalg import expm
+
+from calc.dragimm import (
+    FilterState, TransitionMatrices, filter_trajectories_arrays, filter_trajectory_arrays, filter_trajectory_reference, transition_matrices, transition_rate,
+    viterbi
+)
+
+
+@pytest.fixture
+def trajectory():
+    rng = np.random.default_rng(1234)
+    n = 300
+    dts = rng.choice([1.0, 2.0, 5.0, 10.0, 60.0, 400.0], size=n, p=[.3, .3, .2, .1, .07, .03])
+    # Standing still, walking and driving
+    speeds = np.repeat([0.0, 1.5, 12.0], n // 3)
+    location_std = rng.choice([-1.0, 5.0, 10.0, 30.0, 120.0], size=n)
+    vehicle_way_distance = rng.uniform(0, 100, size=n)
+    vehicle_way_distance[10] = np.nan
+    return dict(
+        time=1.6e9 + np.cumsum(dts),
+        x=327000 + np.cumsum(speeds * dts + rng.normal(0, 5, size=n)),
+        y=6820000 + np.cumsum(rng.normal(0, 5, size=n)),
+        location_std=location_std,
+        atype=rng.integers(-1, 4, size=n),
+        aconf=rng.choice([0.3, 0.5, 0.75], size=n),
+        vehicle_way_distance=vehicle_way_distance,
+    )
+
+
+def test_compiled_filter_matches_reference(trajectory):
+    ms, Ss, state_probs, path, loglik = filter_trajectory_arrays(**trajectory)
+    ref_ms, ref_Ss, ref_state_probs, ref_path, ref_loglik = filter_trajectory_reference(**trajectory)
+    np.testing.assert_allclose(ms, ref_ms, rtol=1e-9, atol=1e-6)
+    np.testing.assert_allclose(Ss, ref_Ss, rtol=1e-6, atol=1e-6)
+    np.testing.assert_allclose(state_probs, ref_state_probs, rtol=1e-6, atol=1e-9)
+    np.testing.assert_array_equal(path, ref_path)
+    assert loglik == pytest.approx(ref_loglik)
+
+
+def test_transition_matrices_closed_form():
+    matrices = TransitionMatrices(transition_rate)
+    assert matrices.uniform_rate is not None
+    dts = np.array([0.0, 0.3, 1.0, 5.0, 123.4, 5000.0])
+    Ms = matrices.get_many(dts)
+    for dt, M in zip(dts, Ms):
+        np.testing.assert_allclose(M, expm(transition_rate * dt), atol=1e-12)
+
+
+def test_transition_matrices_cached():
+    rate = np.array([
+        [-0.02, 0.01, 0.01],
+        [0.005, -0.01, 0.005],
+        [0.001, 0.002, -0.003],
+    ])
+    matrices = TransitionMatrices(rate, dt_quantum=0.5)
+    assert matrices.uniform_rate is None
+    Ms = matrices.get_many([1.0, 5.0, 1.0, 5.2])
+    np.testing.assert_allclose(Ms[0], expm(rate * 1.0))
+    np.testing.assert_allclose(Ms[1], expm(rate * 5.0))
+    np.testing.assert_array_equal(Ms[0], Ms[2])
+    # dt is rounded to the nearest quantum
+    np.testing.assert_allclose(Ms[3], expm(rate * 5.0))
+    np.testing.assert_allclose(matrices.get(5.0), expm(rate * 5.0))
+
+
+def test_viterbi_finds_most_likely_path():
+    rng = np.random.default_rng(5)
+    n_states = 4
+    emissions = rng.dirichlet(np.ones(n_states), size=6)
+    initial_probs = np.ones(n_states) / n_states
+    Ms = transition_matrices.get_many(np.array([0.0, 1.0, 300.0, 5.0, 2000.0, 60.0]))
+
+    def path_logprob(path):
+        logprob = np.log(initial_probs[path[0]]) + np.log(emissions[0, path[0]])
+        for i in range(1, len(path)):
+            logprob += np.log(Ms[i, path[i - 1], path[i]]) + np.log(emissions[i, path[i]])
+        return logprob
+
+    best_path = max(itertools.product(range(n_states), repeat=len(emissions)), key=path_logprob)
+    np.testing.assert_array_equal(viterbi(initial_probs, Ms, emissions), best_path)
+
+
+def test_filter_state_continues_filtering(trajectory):
+    ms, Ss, state_probs, path, _ = filter_trajectory_arrays(**trajectory)
+
+    split = 123
+    state = FilterState()
+    first = filter_trajectory_arrays(**{key: val[:split] for key, val in trajectory.items()}, state=state)
+    assert state.time == trajectory['time'][split - 1]
+    # Checkpoints are stored as JSON
+    state = FilterState.from_dict(json.loads(json.dumps(state.to_dict())))
+    second = filter_trajectory_arrays(**{key: val[split:] for key, val in trajectory.items()}, state=state)
+    assert state.time == trajectory['time'][-1]
+
+    np.testing.assert_allclose(np.concatenate([first[0], second[0]]), ms)
+    np.testing.assert_allclose(np.concatenate([first[1], second[1]]), Ss)
+    np.testing.assert_allclose(np.concatenate([first[2], second[2]]), state_probs)
+    # The path after the checkpoint is decoded like it would be in one go
+    np.testing.assert_array_equal(second[3], path[split:])
+
+
+def test_smoothing_reduces_location_error():
+    rng = np.random.default_rng(42)
+    n = 600
+    dts = rng.choice([1.0, 2.0, 5.0, 10.0], size=n)
+    speeds = np.repeat([0.0, 1.5, 12.0], n // 3)
+    true_x = 327000 + np.cumsum(speeds * dts)
+    true_y = 6820000 + np.cumsum(0.3 * speeds * dts)
+    location_std = rng.choice([5.0, 10.0, 30.0], size=n)
+    trajectory = dict(
+        time=1.6e9 + np.cumsum(dts),
+        x=true_x + rng.normal(0, 1, size=n) * location_std,
+        y=true_y + rng.normal(0, 1, size=n) * location_std,
+        location_std=location_std,
+        atype=rng.integers(-1, 4, size=n),
+        aconf=np.full(n, 0.5),
+        vehicle_way_distance=np.full(n, 50.0),
+    )
+    ms, _, state_probs, path, _ = filter_trajectory_arrays(**trajectory)
+    smoothed_ms, smoothed_Ss, smoothed_state_probs, smoothed_path, _ = filter_trajectory_arrays(
+        **trajectory, smooth=True
+    )
+
+    def rms_error(ms):
+        return np.sqrt(np.mean((ms[:, 0] - true_x) ** 2 + (ms[:, 1] - true_y) ** 2))
+
+    assert rms_error(smoothed_ms) < rms_error(ms)
+    assert np.all(np.linalg.eigvalsh(smoothed_Ss) > 0)
+    # The last sample has nothing to smooth with
+    np.testing.assert_allclose(smoothed_ms[-1], ms[-1])
+    # Mode estimates are not affected
+    np.testing.assert_array_equal(smoothed_state_probs, state_probs)
+    np.testing.assert_array_equal(smoothed_path, path)
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_batched_filtering_matches_single_trajectories(trajectory, parallel):
+    offsets = np.array([0, 1, 100, 100, 250, 300])
+    ms, Ss, state_probs, path, logliks = filter_trajectories_arrays(
+        **trajectory, offsets=offsets, smooth=True, parallel=parallel
+    )
+    assert len(logliks) == len(offsets) - 1
+    for k, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        if start == end:
+            continue
+        single = filter_trajectory_arrays(
+            **{key: val[start:end] for key, val in trajectory.items()}, smooth=True
+        )
+        np.testing.assert_allclose(ms[start:end], single[0])
+        np.testing.assert_allclose(Ss[start:end], single[1])
+        np.testing.assert_allclose(state_probs[start:end], single[2])
+        np.testing.assert_array_equal(path[start:end], single[3])
+        assert logliks[k] == pytest.approx(single[4])
@@ -0,0 +1,162 @@
+import struct
+import uuid
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from calc.pgcopy import COPY_SIGNATURE, decode_copy_binary, encode_copy_binary, read_sql_frame
+
+
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+ENCODERS = {
+    'bool': lambda v: struct.pack('>?', v),
+    'int2': lambda v: struct.pack('>h', v),
+    'int4': lambda v: struct.pack('>i', v),
+    'int8': lambda v: struct.pack('>q', v),
+    'float4': lambda v: struct.pack('>f', v),
+    'float8': lambda v: struct.pack('>d', v),
+    'timestamptz': lambda v: struct.pack('>q', (v - PG_EPOCH) // pd.Timedelta('1us')),
+    'text': lambda v: v.encode('utf-8'),
+    'uuid': lambda v: v.bytes,
+}
+
+
+def make_copy_data(columns, rows):
+    out = [COPY_SIGNATURE, struct.pack('>ii', 0, 0)]
+    for row in rows:
+        out.append(struct.pack('>h', len(columns)))
+        for (name, type_name), value in zip(columns, row):
+            if value is None:
+                out.append(struct.pack('>i', -1))
+                continue
+            data = ENCODERS[type_name](value)
+            out.append(struct.pack('>i', len(data)) + data)
+    out.append(struct.pack('>h', -1))
+    return b''.join(out)
+
+
+def test_decode_copy_binary():
+    columns = [
+        ('time', 'timestamptz'), ('x', 'float8'), ('aconf', 'int4'), ('count', 'int8'), ('small', 'int2'),
+        ('speed', 'float4'), ('is_moving', 'bool'), ('atype', 'text'), ('uuid', 'uuid'),
+    ]
+    uid = uuid.uuid4()
+    rows = [
+        (datetime(2022, 1, 1, 12, 0, 0, 500, tzinfo=timezone.utc), 1.5, 80, 2 ** 40, -3, 0.5, True, 'on_foot', uid),
+        (datetime(1999, 12, 31, 23, 59, tzinfo=timezone.utc), -2.25, None, 0, 7, None, None, 'päivä', None),
+        (datetime(2022, 1, 2, tzinfo=timezone.utc), None, 20, -1, 0, 1.0, False, None, uid),
+    ]
+    df = decode_copy_binary(make_copy_data(columns, rows), columns)
+
+    assert list(df.columns) == [name for name, _ in columns]
+    assert list(df.time) == [pd.Timestamp(row[0]) for row in rows]
+    assert str(df.time.dt.tz) == 'UTC'
+    np.testing.assert_array_equal(df.x, [1.5, -2.25, np.nan])
+    np.testing.assert_array_equal(df.aconf, [80, np.nan, 20])
+    assert df['count'].dtype == np.int64 and list(df['count']) == [2 ** 40, 0, -1]
+    assert list(df.small) == [-3, 7, 0]
+    np.testing.assert_array_equal(df.speed, [0.5, np.nan, 1.0])
+    assert list(df.is_moving) == [True, None, False]
+    assert list(df.atype.isna()) == [False, False, True]
+    assert list(df.atype[:2]) == ['on_foot', 'päivä']
+    assert list(df.uuid.isna()) == [False, True, False]
+    assert df.uuid[0] == str(uid)
+
+
+def test_decode_copy_binary_empty():
+    columns = [('time', 'timestamptz'), ('x', 'float8'), ('atype', 'text')]
+    df = decode_copy_binary(make_copy_data(columns, []), columns)
+    assert len(df) == 0
+    assert list(df.columns) == ['time', 'x', 'atype']
+
+
+def test_decode_copy_binary_numeric():
+    with pytest.raises(ValueError):
+        decode_copy_binary(make_copy_data([('d', 'float8')], [(1.0,)]), [('d', 'numeric')])
+
+
+def test_encode_copy_binary():
+    times = pd.Series(pd.to_datetime(['2022-01-01 12:00:00.000500', '1999-12-31 23:59:00.000000'], utc=True))
+    data = encode_copy_binary([
+        ('int8', np.array([1, 2 ** 40])),
+        ('int4', np.array([7, -2])),
+        ('point', (np.array([23.76, 23.77]), np.array([61.49, 61.5]), 4326)),
+        ('timestamptz', times),
+        ('float8', np.array([1.5, np.nan])),
+    ])
+    df = decode_copy_binary(data, [
+        ('id', 'int8'), ('leg_id', 'int4'), ('loc', 'bytea'), ('time', 'timestamptz'), ('speed', 'float8'),
+    ])
+
+    assert list(df.id) == [1, 2 ** 40]
+    assert list(df.leg_id) == [7, -2]
+    assert list(df.time) == list(times)
+    np.testing.assert_array_equal(df.speed, [1.5, np.nan])
+    for x, y, ewkb in zip([23.76, 23.77], [61.49, 61.5], df['loc']):
+        assert ewkb == struct.pack('<BIIdd', 1, 0x20000001, 4326, x, y)
+
+
+class FakeCursor:
+    """Stands in for a psycopg2 cursor that returns `rows` for any query."""
+
+    def __init__(self, columns, rows, type_codes):
+        self.columns = columns
+        self.rows = rows
+        self.type_codes = type_codes
+        self.executed = []
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def mogrify(self, query, params):
+        return (query % {key: repr(val) for key, val in (params or {}).items()}).encode('utf-8')
+
+    def execute(self, query):
+        self.executed.append(query)
+        Column = type('Column', (), {})
+        self.description = []
+        for (name, _), type_code in zip(self.columns, self.type_codes):
+            col = Column()
+            col.name, col.type_code = name, type_code
+            self.description.append(col)
+
+    def copy_expert(self, query, out):
+        self.executed.append(query)
+        out.write(make_copy_data(self.columns, self.rows))
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        return self._cursor
+
+
+def test_read_sql_frame_describes_query_once():
+    columns = [('x', 'float8'), ('n', 'int8')]
+    curs = FakeCursor(columns, [(1.5, 1), (2.5, 2)], [701, 20])
+    conn = FakeConnection(curs)
+    query = 'SELECT x, n FROM t WHERE n > %(min_n)s'
+
+    df = read_sql_frame(conn, query, dict(min_n=0))
+    assert list(df.x) == [1.5, 2.5] and list(df.n) == [1, 2]
+    assert len(curs.executed) == 2 and curs.executed[0].endswith('LIMIT 0')
+
+    # The column types are known now, so only the COPY is run
+    curs.executed = []
+    df = read_sql_frame(conn, query, dict(min_n=1))
+    assert len(df) == 2
+    assert curs.executed == ['COPY (SELECT x, n FROM t WHERE n > 1) TO STDOUT (FORMAT binary)']
+
+    # Neither are they looked up if they are given
+    curs.executed = []
+    read_sql_frame(conn, 'SELECT x, n FROM u', columns=columns)
+    assert len(curs.executed) == 1
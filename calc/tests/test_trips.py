@@ -0,0 +1,215 @@
+import numpy as np
+import pandas as pd
+
+from shapely import wkb
+from shapely.geometry import LineString
+
+from calc.dragimm import FilterState
+from calc.trips import (
+    MINS_BETWEEN_TRIPS, filter_trips, get_transit_leg_tracks, make_ewkb_linestring, simplify_legs, simplify_track,
+    split_trip_chunks, split_trips
+)
+
+
+def synchronized_errors(time, x, y, keep):
+    # Distance of every sample to its time-interpolated point on the kept track
+    kept = np.flatnonzero(keep)
+    ix = np.interp(time, time[kept], x[kept])
+    iy = np.interp(time, time[kept], y[kept])
+    return np.hypot(ix - x, iy - y)
+
+
+def test_simplify_track():
+    rng = np.random.default_rng(0)
+    time = np.cumsum(rng.uniform(1, 5, size=500))
+    heading = np.cumsum(rng.normal(0, 0.1, size=500))
+    speed = rng.uniform(5, 15, size=500)
+    x = np.cumsum(np.cos(heading) * speed)
+    y = np.cumsum(np.sin(heading) * speed)
+
+    keep, error = simplify_track(time, x, y, 5.0)
+    assert keep[0] and keep[-1]
+    assert keep.sum() < len(keep) / 2
+    errors = synchronized_errors(time, x, y, keep)
+    assert errors.max() <= 5.0
+    assert np.isclose(errors.max(), error)
+
+    keep, error = simplify_track(time, x, y, 0.0)
+    assert keep.all() and error == 0
+
+
+def test_simplify_track_straight_line():
+    time = np.arange(10, dtype=np.float64)
+    x = time * 10
+    y = np.zeros(10)
+    keep, error = simplify_track(time, x, y, 1.0)
+    assert list(np.flatnonzero(keep)) == [0, 9]
+    assert error == 0
+
+    # Stopping halfway is not on the constant speed track
+    x = np.minimum(time, 5) * 10
+    keep, error = simplify_track(time, x, y, 1.0)
+    assert keep[5]
+
+
+def test_simplify_legs():
+    n = 100
+    time = pd.Series(pd.date_range('2022-01-01', periods=n, freq='5s', tz='UTC'))
+    x = np.arange(n) * 50.0
+    df = pd.DataFrame(dict(
+        time=time, x=x, y=np.zeros(n), leg_id=np.repeat([0, 1], n // 2),
+        distance=np.diff(x, prepend=0.0),
+    ))
+    df.loc[n // 2, 'distance'] = 0
+
+    out, errors = simplify_legs(df, 1.0)
+    assert list(out.index) == [0, n // 2 - 1, n // 2, n - 1]
+    assert errors.keys() == {0, 1}
+    assert max(errors.values()) < 1e-6
+    assert out.groupby('leg_id').distance.sum().to_dict() == df.groupby('leg_id').distance.sum().to_dict()
+
+
+def test_make_ewkb_linestring():
+    x = np.array([327000.0, 327010.5, 327020.25])
+    y = np.array([6820000.0, 6820001.0, 6820003.5])
+    assert make_ewkb_linestring(x, y) == wkb.dumps(LineString(np.column_stack((x, y))), srid=3067)
+    # Lines of a single sample get a second vertex
+    line = wkb.loads(make_ewkb_linestring(x[:1], y[:1]))
+    assert list(line.coords) == [(x[0], y[0])] * 2
+
+
+def make_location_samples(rng, n_trips=30):
+    rows = []
+    time = pd.Timestamp('2022-01-01', tz='UTC')
+    for trip in range(n_trips):
+        x, y = 327000.0, 6820000.0
+        for i in range(int(rng.integers(5, 200))):
+            time += pd.Timedelta(seconds=int(rng.integers(1, 30)))
+            x += rng.normal(0, 20)
+            y += rng.normal(0, 20)
+            rows.append(dict(
+                time=time, x=x, y=y, loc_error=float(rng.uniform(1, 150)),
+                is_moving=bool(rng.random() > 0.01), created_at=time.floor('10min'),
+            ))
+        time += pd.Timedelta(minutes=int(rng.integers(21, 300)))
+    return pd.DataFrame(rows)
+
+
+def assert_same_trips(df, include_all, chunk_size):
+    expected = split_trips(df.copy(), include_all=include_all)
+    batches = (df.iloc[i:i + chunk_size] for i in range(0, len(df), chunk_size))
+    out = list(split_trip_chunks(batches, include_all=include_all))
+    for trips in out:
+        assert len(trips)
+    got = pd.concat(out, ignore_index=True)
+    assert list(got.columns) == list(expected.columns)
+    assert list(got.time) == list(expected.time)
+    assert list(got.trip_id) == list(expected.trip_id)
+
+
+def test_split_trip_chunks():
+    df = make_location_samples(np.random.default_rng(0))
+    for include_all in (False, True):
+        for chunk_size in (7, 100, 1000, len(df)):
+            assert_same_trips(df, include_all, chunk_size)
+
+
+def test_split_trip_chunks_after_last_not_moving():
+    # Trips after the last "not moving" sample are dropped even when they
+    # come in earlier chunks than the end of the samples.
+    df = make_location_samples(np.random.default_rng(1))
+    df['is_moving'] = True
+    df.loc[len(df) // 3, 'is_moving'] = False
+    for chunk_size in (7, 100, 1000):
+        assert_same_trips(df, False, chunk_size)
+
+    # Without any "not moving" samples, only the last burst is dropped
+    df['is_moving'] = True
+    for chunk_size in (7, 100):
+        assert_same_trips(df, False, chunk_size)
+
+
+def make_trip_samples(rng, n=200, start='2022-01-01'):
+    dts = rng.choice([1, 2, 5, 10, 60], size=n, p=[.3, .3, .2, .1, .1])
+    time = pd.Timestamp(start, tz='UTC') + pd.to_timedelta(np.cumsum(dts), unit='s')
+    speeds = np.repeat([1.5, 12.0], [n // 2, n - n // 2])
+    return pd.DataFrame(dict(
+        time=time,
+        x=327000 + np.cumsum(speeds * dts + rng.normal(0, 5, size=n)),
+        y=6820000 + np.cumsum(rng.normal(0, 5, size=n)),
+        loc_error=rng.choice([5.0, 10.0, 30.0], size=n),
+        atype=rng.choice(['on_foot', 'in_vehicle', 'still'], size=n),
+        aconf=rng.choice([30.0, 50.0, 75.0], size=n),
+        closest_car_way_dist=rng.uniform(0, 100, size=n),
+        closest_rail_way_dist=np.nan,
+    ))
+
+
+def test_filter_trips_resumes_from_checkpoint():
+    df = make_trip_samples(np.random.default_rng(0))
+    full = filter_trips(df.copy())
+
+    split = 123
+    state = FilterState()
+    first = filter_trips(df.iloc[:split].copy(), filter_state=state)
+    # The checkpoint is stored between runs
+    state = state.copy()
+    second = filter_trips(df.iloc[split:].copy(), filter_state=state)
+
+    resumed = pd.concat([first, second])
+    np.testing.assert_allclose(resumed[['xf', 'yf']].to_numpy(), full[['xf', 'yf']].to_numpy())
+    assert list(second.atypef) == list(full.atypef.iloc[split:])
+
+
+def test_filter_trips_resets_checkpoint_after_trip_gap():
+    rng = np.random.default_rng(1)
+    state = FilterState()
+    filter_trips(make_trip_samples(rng), filter_state=state)
+
+    df = make_trip_samples(rng)
+    df['time'] = pd.Timestamp(state.time, unit='s', tz='UTC') + pd.Timedelta(minutes=MINS_BETWEEN_TRIPS + 1) + (
+        df.time - df.time.iloc[0]
+    )
+    resumed = filter_trips(df.copy(), filter_state=state)
+    fresh = filter_trips(df.copy())
+    np.testing.assert_allclose(resumed[['xf', 'yf']].to_numpy(), fresh[['xf', 'yf']].to_numpy())
+    assert list(resumed.atypef) == list(fresh.atypef)
+
+
+def test_split_trip_chunks_casts_null_columns():
+    df = make_location_samples(np.random.default_rng(2))
+    df['speed'] = np.nan
+    df.loc[:99, 'loc_error'] = np.nan
+    expected = split_trips(df.copy())
+
+    # Rows read through a cursor come as Python objects, so a chunk where
+    # a column is all NULL has no float type
+    columns = list(df.columns)
+    rows = [
+        tuple(None if isinstance(v, float) and np.isnan(v) else v for v in row)
+        for row in df.itertuples(index=False)
+    ]
+    batches = (
+        pd.DataFrame.from_records(rows[i:i + 50], columns=columns, coerce_float=True)
+        for i in range(0, len(rows), 50)
+    )
+    got = pd.concat(list(split_trip_chunks(batches)), ignore_index=True)
+    assert got.dtypes.equals(expected.dtypes)
+    assert list(got.time) == list(expected.time)
+    assert list(got.trip_id) == list(expected.trip_id)
+
+
+def test_get_transit_leg_tracks():
+    time = pd.Series(pd.date_range('2022-01-01', periods=4, freq='10s', tz='UTC'))
+    leg = pd.DataFrame(dict(
+        time=time, x=[0.0, 10.0, 5000.0, 30.0], y=[0.0, 0.0, 5000.0, 0.0], loc_error=[5.0, 200.0, 1500.0, np.nan],
+    ))
+    inaccurate = leg.assign(loc_error=500.0)
+
+    legs = get_transit_leg_tracks({1: leg, 2: inaccurate})
+    assert len(legs) == 1
+    leg_id, start_time, end_time, x, y = legs[0]
+    assert leg_id == 1
+    # The time range covers all the samples, the track only the accurate ones
+    assert (start_time, end_time) == (time.iloc[0], time.iloc[-1])
+    assert list(x) == [0.0, 10.0] and list(y) == [0.0, 0.0]
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from shapely.geometry import LineString, Point
+
+from calc.wayindex import CAR_WAYS, RAIL_WAYS, WayIndex, build_way_index, get_way_index
+
+
+@pytest.fixture
+def ways():
+    rng = np.random.default_rng(0)
+    ways = []
+    for osm_id in range(300):
+        start = rng.uniform(0, 2000, size=2) + [327000, 6820000]
+        coords = start + np.cumsum(rng.normal(0, 80, size=(rng.integers(2, 10), 2)), axis=0)
+        kind = rng.choice([CAR_WAYS, RAIL_WAYS])
+        # Leave some ways without a name
+        name = 'Katu %d' % osm_id if osm_id % 3 else None
+        way_type = 'residential' if kind == CAR_WAYS else 'tram'
+        ways.append((kind, osm_id, name, way_type, coords))
+    return ways
+
+
+def test_nearest_ways_match_brute_force(ways, tmp_path):
+    path = str(tmp_path / 'ways')
+    build_way_index(ways).save(path)
+    index = WayIndex.load(path)
+
+    rng = np.random.default_rng(1)
+    x = rng.uniform(327000, 329000, size=200)
+    y = rng.uniform(6820000, 6822000, size=200)
+    out = index.nearest_ways(x, y, max_distance=50)
+
+    lines = [(kind, osm_id, LineString(coords)) for kind, osm_id, name, way_type, coords in ways]
+    names = {osm_id: name for kind, osm_id, name, way_type, coords in ways}
+    types = {osm_id: way_type for kind, osm_id, name, way_type, coords in ways}
+    for i in range(len(x)):
+        point = Point(x[i], y[i])
+        for kind, prefix in ((CAR_WAYS, 'closest_car_way'), (RAIL_WAYS, 'closest_rail_way')):
+            dist, osm_id = min((line.distance(point), osm_id) for k, osm_id, line in lines if k == kind)
+            if dist <= 50:
+                assert out['%s_dist' % prefix][i] == pytest.approx(dist, abs=0.05)
+                assert out['%s_id' % prefix][i] == str(osm_id)
+                assert out['%s_name' % prefix][i] == names[osm_id]
+                assert out['%s_type' % prefix][i] == types[osm_id]
+            else:
+                assert np.isnan(out['%s_dist' % prefix][i])
+                assert out['%s_id' % prefix][i] is None
+                assert out['%s_name' % prefix][i] is None
+                assert out['%s_type' % prefix][i] is None
+
+
+def test_empty_index():
+    index = build_way_index([])
+    out = index.nearest_ways(np.array([327000.0]), np.array([6820000.0]))
+    assert np.isnan(out['closest_car_way_dist'][0])
+    assert out['closest_rail_way_id'][0] is None
+
+
+def test_get_way_index_reloads_rebuilt_index(ways, tmp_path):
+    path = str(tmp_path / 'ways')
+    build_way_index(ways[:10]).save(path)
+    index = get_way_index(path)
+    assert get_way_index(path) is index
+
+    build_way_index(ways).save(path)
+    reloaded = get_way_index(path)
+    assert reloaded is not index
+    assert len(reloaded.arrays['way_ids']) == len(ways)
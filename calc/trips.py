@@ -1,12 +1,16 @@
 import os
 import logging
+import struct
 import numba
 import numpy as np
 from datetime import datetime, timedelta
 import pandas as pd
 from utils.perf import PerfCounter
 
-from .dragimm import filter_trajectory, filters as transport_modes
+from .pgcopy import read_sql_frame
+from .dragimm import (
+    FilterState, filter_idx, filter_trajectories_arrays, filter_trajectory_arrays, filters as transport_modes
+)
 from .transitest import transit_prob_ests_糞
 
 
@@ -25,64 +29,121 @@ LOCAL_2D_CRS = 3067
 logger = logging.getLogger(__name__)
 
 
+# Prepared statements, each in sql/<name>.sql
+SQL_STATEMENTS = ('annotate_location_ways',)
+
+
 def prepare_sql_statements(conn):
     with conn.cursor() as curs:
-        # Check if we have prepared the statement for this DB session before.
+        # Check which statements we have prepared for this DB session before.
         curs.execute(
-            'SELECT COUNT(*) FROM pg_prepared_statements WHERE name = %(name)s',
-            dict(name='read_locations')
+            'SELECT name FROM pg_prepared_statements WHERE name IN %(names)s',
+            dict(names=SQL_STATEMENTS)
         )
-        rows = curs.fetchall()
-        if rows[0][0]:
-            return
+        prepared = set(row[0] for row in curs.fetchall())
 
         path = os.path.dirname(__file__)
-        fn = os.path.join(path, 'sql', 'read_locations.sql')
-        query = open(fn, 'r').read()
-        with conn.cursor() as curs:
+        for name in SQL_STATEMENTS:
+            if name in prepared:
+                continue
+            fn = os.path.join(path, 'sql', '%s.sql' % name)
+            query = open(fn, 'r').read()
             curs.execute(query)
 
 
-def read_locations(conn, uid, start_time=None, end_time=None, include_all=False):
-    pc = PerfCounter('read %s' % uid, show_time_to_last=True)
+def annotate_location_ways(conn, uid, start_time, end_time):
+    """Store the nearest car and rail ways of the samples that don't have them yet.
 
+    New samples get them when they are saved; this fills in the older ones
+    and the ones reset after refreshing the OSM views.
+    """
     prepare_sql_statements(conn)
+    with conn.cursor() as curs:
+        curs.execute(
+            'EXECUTE annotate_location_ways(%(uuid)s, %(start_time)s, %(end_time)s)',
+            dict(uuid=uid, start_time=start_time, end_time=end_time)
+        )
+        return curs.rowcount
 
+
+def get_sql_query(name):
+    """Return the query in sql/<name>.sql (with pyformat placeholders)."""
+    fn = os.path.join(os.path.dirname(__file__), 'sql', '%s.sql' % name)
+    return open(fn, 'r').read()
+
+
+def _get_time_range(start_time, end_time):
     if start_time is None:
         start_time = '2010-01-01'
     if end_time is None:
         end_time = 'NOW()'
+    return start_time, end_time
+
+
+def _add_nearest_ways(df, way_index):
+    for col, values in way_index.nearest_ways(df.x.to_numpy(), df.y.to_numpy()).items():
+        df[col] = values
 
-    params = dict(uuid=uid, start_time=start_time, end_time=end_time)
-    query = 'EXECUTE read_locations(%(uuid)s, %(start_time)s, %(end_time)s)'
-    df = pd.read_sql_query(query, conn, params=params)
-    pc.display('query done, got %d rows' % len(df))
 
+def add_way_names(conn, df):
+    """Add the names and types of the nearest ways of read_locations() samples.
+
+    The names are only needed for showing the samples, so they are looked
+    up for the distinct ways instead of every sample.
+    """
+    for prefix, view, type_column in (
+        ('closest_car_way', 'planet_osm_car_ways', 'highway'),
+        ('closest_rail_way', 'planet_osm_rail_ways', 'railway'),
+    ):
+        ids = df['%s_id' % prefix].dropna().unique().tolist()
+        names = {}
+        types = {}
+        if ids:
+            with conn.cursor() as curs:
+                curs.execute(
+                    f'SELECT osm_id :: varchar, name, {type_column} FROM {view} WHERE osm_id = ANY(%(ids)s)',
+                    dict(ids=[int(x) for x in ids])
+                )
+                for osm_id, name, way_type in curs.fetchall():
+                    names[osm_id] = name
+                    types[osm_id] = way_type
+        df['%s_name' % prefix] = df['%s_id' % prefix].map(names)
+        df['%s_type' % prefix] = df['%s_id' % prefix].map(types)
+
+
+def _split_trips(df, first_trip_id=0):
     df['time'] = pd.to_datetime(df.time, utc=True)
     df['timediff'] = df['time'].diff().dt.total_seconds().fillna(value=0)
     df['new_trip'] = df['timediff'] > MINS_BETWEEN_TRIPS * 60
-    df['trip_id'] = df['new_trip'].cumsum()
+    df['trip_id'] = df['new_trip'].cumsum() + first_trip_id
     d = ((df.x - df.x.shift()) ** 2 + (df.y - df.y.shift()) ** 2).pow(.5).fillna(0)
     df['distance'] = d
 
+
+def _drop_unfinished_samples(df, seen_not_moving=False, max_created_at=None):
     # Filter out everything after the latest "not moving" event,
     # because a trip might still be ongoing
-    if not include_all:
-        not_moving = df[df.is_moving == False]
-        if not len(not_moving):
-            # If we don't have any "not moving" samples, just filter
-            # out the last burst.
-            df = df[df.created_at < df.created_at.max()]
-        else:
-            last_not_moving = not_moving.time.max()
-            df = df[df.time <= last_not_moving]
-
-    # Filter out trips that do not have enough low location error samples
-    # far enough from the trip center point.
+    not_moving = df[df.is_moving == False]
+    if not len(not_moving):
+        if seen_not_moving:
+            # The latest "not moving" event was before these samples
+            return df.iloc[0:0]
+        # If we don't have any "not moving" samples, just filter
+        # out the last burst.
+        if max_created_at is None:
+            max_created_at = df.created_at.max()
+        return df[df.created_at < max_created_at]
+    last_not_moving = not_moving.time.max()
+    return df[df.time <= last_not_moving]
+
+
+def _mark_short_trips(df):
+    """Set trip_id to -1 for trips that do not have enough low location error
+    samples far enough from the trip center point.
+
+    Returns the ids of the trips kept.
+    """
     good_samples = df[df.loc_error < 100]
-    if not len(good_samples):
-        print('No good samples, returning')
-        return
 
     avg_loc = good_samples.groupby('trip_id')[['x', 'y']].mean()
     avg_loc.columns = ['avg_x', 'avg_y']
@@ -93,16 +154,200 @@ def read_locations(conn, uid, start_time=None, end_time=None, include_all=False)
     trips_to_keep = loc_count.index[loc_count > 10]
 
     df.loc[~df.trip_id.isin(trips_to_keep), 'trip_id'] = -1
+    return trips_to_keep
+
+
+def split_trips(df, include_all=False):
+    """Split location samples in time order into trips.
+
+    Adds the trip_id and distance columns. Unless `include_all` is set,
+    drops the samples that might belong to an ongoing trip and the trips
+    that are too short. Returns None if there are no good samples.
+    """
+    _split_trips(df)
+    if not include_all:
+        df = _drop_unfinished_samples(df)
 
+    if not (df.loc_error < 100).any():
+        print('No good samples, returning')
+        return
+
+    df = df.copy()
+    _mark_short_trips(df)
     if not include_all:
         df = df[df.trip_id >= 0]
 
-    df = df.drop(columns=['timediff', 'new_trip'])
-    pc.display('returning %d trips (%d rows)' % (len(trips_to_keep), len(df)))
+    return df.drop(columns=['timediff', 'new_trip'])
+
+
+# Columns of the read_locations query that are always floats. When the
+# samples are read in chunks, a chunk where a column is all NULL would
+# otherwise end up with object dtype.
+LOCATION_FLOAT_COLUMNS = (
+    'x', 'y', 'loc_error', 'aconf', 'speed', 'heading', 'odometer', 'closest_car_way_dist', 'closest_rail_way_dist',
+)
+LOCATION_TIME_COLUMNS = ('time', 'created_at')
+
 
+def _cast_location_columns(df):
+    for col in LOCATION_FLOAT_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype(np.float64)
+    for col in LOCATION_TIME_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], utc=True)
     return df
 
 
+def split_trip_chunks(batches, include_all=False):
+    """Split consecutive batches of location samples into trips.
+
+    Works like split_trips() on all the samples at once, and gives the same
+    trip ids, rows and column types, but yields DataFrames that each hold
+    one or more complete trips. A trip is complete when it is followed by a
+    trip gap and, unless `include_all` is set, a "not moving" sample has
+    been seen at or after its end. Otherwise split_trips() might still drop
+    its samples, so it is held back until then, at worst until the end.
+    """
+    next_trip_id = 0
+    seen_not_moving = False
+    last_not_moving = None
+    max_created_at = None
+    # Samples after the last trip gap
+    pending = None
+    # Trips that end after the latest "not moving" sample
+    held = None
+
+    def finish(df):
+        df = df.copy()
+        _mark_short_trips(df)
+        if not include_all:
+            df = df[df.trip_id >= 0]
+        return df.drop(columns=['timediff', 'new_trip'])
+
+    for chunk in batches:
+        chunk = _cast_location_columns(chunk.copy())
+        not_moving = chunk.time[chunk.is_moving == False]
+        if len(not_moving):
+            seen_not_moving = True
+            last_not_moving = not_moving.max()
+        chunk_max_created_at = chunk.created_at.max()
+        if max_created_at is None or chunk_max_created_at > max_created_at:
+            max_created_at = chunk_max_created_at
+
+        if pending is not None:
+            chunk = pd.concat([pending, chunk], ignore_index=True)
+        # Everything before the last trip gap is split into trips
+        gaps = np.flatnonzero(chunk['time'].diff().dt.total_seconds() > MINS_BETWEEN_TRIPS * 60)
+        if not len(gaps):
+            pending = chunk
+            continue
+        pending = chunk.iloc[gaps[-1]:].reset_index(drop=True)
+        df = chunk.iloc[:gaps[-1]].copy()
+        _split_trips(df, first_trip_id=next_trip_id)
+        next_trip_id = df['trip_id'].iloc[-1] + 1
+
+        if not include_all:
+            if held is not None:
+                df = pd.concat([held, df], ignore_index=True)
+            trip_ends = df.groupby('trip_id')['time'].max()
+            if last_not_moving is None:
+                done_trips = trip_ends.index[:0]
+            else:
+                done_trips = trip_ends.index[trip_ends <= last_not_moving]
+            is_done = df.trip_id.isin(done_trips)
+            held = df[~is_done].reset_index(drop=True)
+            df = df[is_done]
+        if not len(df):
+            continue
+        df = finish(df)
+        if len(df):
+            yield df
+
+    parts = [held] if held is not None and len(held) else []
+    if pending is not None:
+        _split_trips(pending, first_trip_id=next_trip_id)
+        parts.append(pending)
+    if not parts:
+        return
+    df = pd.concat(parts, ignore_index=True)
+    if not include_all:
+        df = _drop_unfinished_samples(df, seen_not_moving=seen_not_moving, max_created_at=max_created_at)
+    if not len(df):
+        return
+    df = finish(df)
+    if len(df):
+        yield df
+
+
+def read_locations(conn, uid, start_time=None, end_time=None, include_all=False, way_index=None):
+    """Read the location samples of a device and split them into trips.
+
+    The nearest ways are the ones stored with the samples, without names
+    (see add_way_names()). If a calc.wayindex.WayIndex is given as
+    `way_index`, they are looked up from it instead, including the names
+    and types.
+    """
+    pc = PerfCounter('read %s' % uid, show_time_to_last=True)
+
+    start_time, end_time = _get_time_range(start_time, end_time)
+
+    params = dict(uuid=uid, start_time=start_time, end_time=end_time)
+    df = read_sql_frame(conn, get_sql_query('read_locations'), params)
+    pc.display('query done, got %d rows' % len(df))
+
+    if way_index is not None:
+        _add_nearest_ways(df, way_index)
+        pc.display('nearest ways found')
+
+    df = split_trips(df, include_all=include_all)
+    if df is not None:
+        pc.display('returning %d trips (%d rows)' % (df.trip_id.nunique(), len(df)))
+    return df
+
+
+def read_locations_chunked(
+    conn, uid, start_time=None, end_time=None, include_all=False, way_index=None, chunk_size=20000
+):
+    """Read the location samples like read_locations(), but in chunks.
+
+    The samples are read with binary COPY `chunk_size` rows at a time and
+    split into trips with split_trip_chunks(). Yields DataFrames that each
+    hold one or more complete trips; a trip longer than `chunk_size` rows
+    is yielded whole.
+    """
+    pc = PerfCounter('read %s' % uid, show_time_to_last=True)
+
+    start_time, end_time = _get_time_range(start_time, end_time)
+    # The sample times of a device are unique, so each chunk continues
+    # from the last sample of the previous one.
+    query = f"""
+        SELECT * FROM ({get_sql_query('read_locations')}) AS q
+        WHERE q.time > %(after)s
+        ORDER BY q.time
+        LIMIT {int(chunk_size)}
+    """
+
+    def read_batches():
+        after = '-infinity'
+        while True:
+            params = dict(uuid=uid, start_time=start_time, end_time=end_time, after=after)
+            chunk = read_sql_frame(conn, query, params)
+            pc.display('query done, got %d rows' % len(chunk))
+            if not len(chunk):
+                break
+            if way_index is not None:
+                _add_nearest_ways(chunk, way_index)
+            yield chunk
+            if len(chunk) < chunk_size:
+                break
+            after = chunk.time.iloc[-1].to_pydatetime()
+
+    for df in split_trip_chunks(read_batches(), include_all=include_all):
+        pc.display('chunk done, %d trips (%d rows)' % (df.trip_id.nunique(), len(df)))
+        yield df
+
+
 ATYPE_MAPPING = {
     'still': 'still',
     'running': 'walking',
@@ -125,26 +370,35 @@ ATYPE_STILL = ALL_ATYPES.index('still')
 ATYPE_UNKNOWN = ALL_ATYPES.index('unknown')
 
 IDX_MAPPING = {idx: ATYPE_REVERSE[x] for idx, x in enumerate(transport_modes.keys())}
+# Map activity types straight to the filter indexes (modes missing here are unknown)
+ATYPE_FILTER_IDX = {atype: filter_idx[mode] for atype, mode in ATYPE_MAPPING.items() if mode is not None}
+
+
+def epoch_seconds(times: pd.Series) -> np.ndarray:
+    s = times.dt.tz_convert(None) - pd.Timestamp('1970-01-01')
+    return (s / pd.Timedelta('1s')).to_numpy(dtype=np.float64)
+
+
+def get_filter_inputs(df: pd.DataFrame):
+    """Return the inputs for filter_trajectory_arrays() from the samples."""
+    aconf = (df['aconf'] / 100).to_numpy(dtype=np.float64, na_value=np.nan)
+    return dict(
+        time=epoch_seconds(df['time']),
+        x=df['x'].to_numpy(dtype=np.float64),
+        y=df['y'].to_numpy(dtype=np.float64),
+        location_std=df['loc_error'].clip(lower=0.1).to_numpy(dtype=np.float64),
+        atype=df['atype'].map(ATYPE_FILTER_IDX).fillna(-1).to_numpy(dtype=np.int64),
+        aconf=np.where(aconf == 1, aconf / 2, aconf),
+        vehicle_way_distance=df[['closest_car_way_dist', 'closest_rail_way_dist']].min(axis=1).to_numpy(
+            dtype=np.float64, na_value=np.nan
+        ),
+    )
 
 
-def filter_trips(df: pd.DataFrame):
-    out = df[['time', 'x', 'y', 'speed']].copy()
-    s = df['time'].dt.tz_convert(None) - pd.Timestamp('1970-01-01')
-    out['time'] = s / pd.Timedelta('1s')
-
-    out['location_std'] = df['loc_error'].clip(lower=0.1)
-    out['atype'] = df['atype'].map(ATYPE_MAPPING)
-    out['aconf'] = df['aconf'] / 100
-    out['vehicle_way_distance'] = df[['closest_car_way_dist', 'closest_rail_way_dist']].min(axis=1)
-    out.loc[out.aconf == 1, 'aconf'] /= 2
-
-    ms, Ss, state_probs, most_likely_path, _ = filter_trajectory((r for i, r in out.iterrows()))
-
-    x = ms[:, 0]
-    y = ms[:, 1]
+def add_filter_outputs(df: pd.DataFrame, ms, state_probs, most_likely_path):
     df = df.copy()
-    df['xf'] = x
-    df['yf'] = y
+    df['xf'] = ms[:, 0]
+    df['yf'] = ms[:, 1]
     df['atypef'] = most_likely_path
     df['atypef'] = df['atypef'].map(IDX_MAPPING)
 
@@ -154,11 +408,47 @@ def filter_trips(df: pd.DataFrame):
             mode = 'in_vehicle'
         elif mode == 'cycling':
             mode = 'on_bicycle'
-        df[mode] = [x[idx] for x in state_probs]
+        df[mode] = state_probs[:, idx]
 
     return df
 
 
+def filter_trips(df: pd.DataFrame, filter_state: FilterState = None, smooth: bool = False):
+    """Filter the samples of one trip.
+
+    If `filter_state` is given, filtering continues from it if the trip
+    starts less than MINS_BETWEEN_TRIPS after the state; otherwise the state
+    is reset. The state is updated to the last sample of the trip.
+
+    With `smooth`, the filtered locations (xf, yf) are smoothed with a
+    backward pass over the trip.
+    """
+    inputs = get_filter_inputs(df)
+    if filter_state is not None and filter_state.time is not None:
+        if not 0 < inputs['time'][0] - filter_state.time <= MINS_BETWEEN_TRIPS * 60:
+            filter_state.reset()
+
+    ms, Ss, state_probs, most_likely_path, _ = filter_trajectory_arrays(
+        **inputs, state=filter_state, smooth=smooth,
+    )
+    return add_filter_outputs(df, ms, state_probs, most_likely_path)
+
+
+def filter_trips_batched(df: pd.DataFrame, smooth: bool = False, parallel: bool = True):
+    """Filter all the trips (by trip_id) in `df` in one compiled call.
+
+    Each trip is filtered from scratch like with filter_trips().
+    """
+    df = df.sort_values('trip_id', kind='stable')
+    trip_ids = df['trip_id'].to_numpy()
+    offsets = np.concatenate(([0], np.flatnonzero(np.diff(trip_ids)) + 1, [len(df)]))
+
+    ms, Ss, state_probs, most_likely_path, _ = filter_trajectories_arrays(
+        **get_filter_inputs(df), offsets=offsets, smooth=smooth, parallel=parallel,
+    )
+    return add_filter_outputs(df, ms, state_probs, most_likely_path)
+
+
 def read_uuids_from_sql(conn):
     print('Reading uids')
     with conn.cursor() as cursor:
@@ -190,7 +480,7 @@ def get_transit_locations(conn, uid: str, start_time: datetime, end_time: dateti
             vehicle_journey_ref,
             vehicle_ref,
             time,
-            extract(epoch from time) AS epoch_time,
+            extract(epoch from time) :: float8 AS epoch_time,
             ST_X(loc) AS x,
             ST_Y(loc) AS y,
             route_type,
@@ -213,10 +503,88 @@ def get_transit_locations(conn, uid: str, start_time: datetime, end_time: dateti
     """
     params = dict(start=start_time, end=end_time, uuid=uid)
 
-    df = pd.read_sql_query(query, conn, params=params)
+    df = read_sql_frame(conn, query, params)
     return df
 
 
+TRANSIT_LEG_CORRIDOR = 200  # m
+TRANSIT_MAX_LOC_ERROR = 200  # m
+
+
+def make_ewkb_linestring(x, y, srid=LOCAL_2D_CRS):
+    coords = np.column_stack((x, y)).astype('<f8')
+    if len(coords) == 1:
+        # A line needs at least two points
+        coords = np.repeat(coords, 2, axis=0)
+    return struct.pack('<BIII', 1, 0x20000002, srid, len(coords)) + coords.tobytes()
+
+
+def get_transit_leg_tracks(leg_dfs):
+    """Return the legs for get_transit_locations_for_legs() from leg DataFrames by leg_id.
+
+    Only the samples with a location error of at most TRANSIT_MAX_LOC_ERROR
+    are used for the track, so that inaccurate fixes don't widen the
+    corridor. Legs without such samples are left out.
+    """
+    legs = []
+    for leg_id, leg_df in leg_dfs.items():
+        good = leg_df[leg_df.loc_error <= TRANSIT_MAX_LOC_ERROR]
+        if not len(good):
+            continue
+        legs.append((leg_id, leg_df.time.min(), leg_df.time.max(), good.x.to_numpy(), good.y.to_numpy()))
+    return legs
+
+
+def get_transit_locations_for_legs(conn, legs):
+    """Find the transit vehicles that were near the legs in one query.
+
+    `legs` is a list of (leg_id, start_time, end_time, x, y) with the
+    (filtered) coordinates of the samples in LOCAL_2D_CRS. Returns the
+    vehicle locations grouped by leg_id and then by vehicle_ref.
+    """
+    if not legs:
+        return {}
+    query = f"""
+        WITH legs AS (
+            SELECT
+                leg_id, start_time, end_time,
+                ST_Buffer(ST_GeomFromEWKB(line), {TRANSIT_LEG_CORRIDOR}) AS corridor
+            FROM unnest(
+                %(leg_ids)s :: bigint[], %(start_times)s :: timestamptz[], %(end_times)s :: timestamptz[],
+                %(lines)s :: bytea[]
+            ) AS t (leg_id, start_time, end_time, line)
+        )
+        SELECT
+            legs.leg_id,
+            vl.vehicle_journey_ref,
+            vl.vehicle_ref,
+            vl.time,
+            extract(epoch from vl.time) :: float8 AS epoch_time,
+            ST_X(vl.loc) AS x,
+            ST_Y(vl.loc) AS y,
+            vl.route_type,
+            routes.route_long_name AS route_name
+        FROM legs
+        JOIN {TRANSIT_TABLE} vl ON
+            vl.time >= legs.start_time - interval '1 minute' AND vl.time <= legs.end_time + interval '1 minute'
+            AND vl.loc && legs.corridor
+        LEFT JOIN gtfs.routes routes ON
+            routes.feed_index = vl.gtfs_feed_id AND routes.route_id = vl.gtfs_route_id
+        ORDER BY legs.leg_id, vl.time
+    """
+    params = dict(
+        leg_ids=[int(leg[0]) for leg in legs],
+        start_times=[leg[1] for leg in legs],
+        end_times=[leg[2] for leg in legs],
+        lines=[make_ewkb_linestring(leg[3], leg[4]) for leg in legs],
+    )
+    df = read_sql_frame(conn, query, params)
+    return {
+        leg_id: {vech: d.drop(columns='leg_id') for vech, d in leg_locs.groupby('vehicle_ref')}
+        for leg_id, leg_locs in df.groupby('leg_id')
+    }
+
+
 @numba.njit(cache=True)
 def filter_legs(time, x, y, atype, distance, loc_error, speed):
     n_rows = len(time)
@@ -282,6 +650,93 @@ def filter_legs(time, x, y, atype, distance, loc_error, speed):
     return leg_ids
 
 
+@numba.njit(cache=True)
+def simplify_track(time, x, y, tolerance):
+    """Simplify a track with the Douglas-Peucker algorithm using the
+    synchronized Euclidean distance.
+
+    The distance of a sample is measured to the point where it would be at
+    its time when moving at constant speed along the simplified segment, so
+    the kept samples represent the timing of the track too. Returns a mask
+    of the samples to keep (always including the first and the last one)
+    and the largest distance of a dropped sample.
+    """
+    n = len(time)
+    keep = np.zeros(n, dtype=np.bool_)
+    max_error = 0.0
+    if n == 0:
+        return keep, max_error
+    keep[0] = True
+    keep[n - 1] = True
+
+    stack = np.empty((n + 1, 2), dtype=np.int64)
+    stack[0, 0] = 0
+    stack[0, 1] = n - 1
+    top = 1
+    while top > 0:
+        top -= 1
+        first = stack[top, 0]
+        last = stack[top, 1]
+        if last - first < 2:
+            continue
+
+        duration = time[last] - time[first]
+        dist = -1.0
+        idx = -1
+        for i in range(first + 1, last):
+            r = (time[i] - time[first]) / duration if duration > 0 else 0.0
+            dx = x[first] + r * (x[last] - x[first]) - x[i]
+            dy = y[first] + r * (y[last] - y[first]) - y[i]
+            d = (dx ** 2 + dy ** 2) ** 0.5
+            if d > dist:
+                dist = d
+                idx = i
+
+        if dist > tolerance:
+            keep[idx] = True
+            stack[top, 0] = first
+            stack[top, 1] = idx
+            stack[top + 1, 0] = idx
+            stack[top + 1, 1] = last
+            top += 2
+        elif dist > max_error:
+            max_error = dist
+
+    return keep, max_error
+
+
+def simplify_legs(df: pd.DataFrame, tolerance: float):
+    """Drop the samples of each leg that are within `tolerance` meters
+    of the simplified track.
+
+    The distances of the dropped samples are added to the next kept sample,
+    so the lengths of the legs stay the same. Returns the simplified samples
+    and the largest error of each leg by leg_id.
+    """
+    time = epoch_seconds(df['time'])
+    x = df['x'].to_numpy(dtype=np.float64)
+    y = df['y'].to_numpy(dtype=np.float64)
+    distance = df['distance'].to_numpy(dtype=np.float64)
+    leg_ids = df['leg_id'].to_numpy()
+
+    keep = np.zeros(len(df), dtype=bool)
+    errors = {}
+    starts = np.flatnonzero(np.diff(leg_ids, prepend=np.nan) != 0) if len(df) else np.array([], dtype=int)
+    for start, end in zip(starts, np.append(starts[1:], len(df))):
+        leg_keep, errors[leg_ids[start]] = simplify_track(
+            time[start:end], x[start:end], y[start:end], tolerance
+        )
+        keep[start:end] = leg_keep
+
+    df = df[keep].copy()
+    # Distance covered since the previous kept sample of the leg
+    cum_distance = np.cumsum(distance)[keep]
+    kept_leg_ids = leg_ids[keep]
+    new_leg = np.diff(kept_leg_ids, prepend=np.nan) != 0
+    df['distance'] = np.where(new_leg, distance[keep], np.diff(cum_distance, prepend=0))
+    return df, errors
+
+
 MAX_DISTANCE_BY_TRANSIT_TYPE = {
     0: 50,  # tram
     2: 500, # train
@@ -319,17 +774,20 @@ def split_trip_legs(conn, uid, df, include_all=False):
 
     df = df.copy()
 
-    for leg_id in df.leg_id.unique():
-        leg_df = df[df.leg_id == leg_id].copy()
-        if leg_df.iloc[0].atype != 'in_vehicle':
-            continue
+    vehicle_legs = {
+        leg_id: leg_df for leg_id, leg_df in df.groupby('leg_id', sort=False)
+        if leg_df.iloc[0].atype == 'in_vehicle'
+    }
+    transit_locs_by_leg = get_transit_locations_for_legs(conn, get_transit_leg_tracks(vehicle_legs))
 
-        transit_locs = get_transit_locations(conn, uid, leg_df.time.min(), leg_df.time.max())
-        if not len(transit_locs):
+    for leg_id, leg_df in vehicle_legs.items():
+        transit_loc_by_id = transit_locs_by_leg.get(leg_id)
+        if not transit_loc_by_id:
             continue
-        transit_locs['time'] = transit_locs.epoch_time
+        leg_df = leg_df.copy()
+        for d in transit_loc_by_id.values():
+            d['time'] = d.epoch_time
         leg_df['location_std'] = leg_df['loc_error']
-        transit_loc_by_id = {vech: d for vech, d in transit_locs.groupby('vehicle_ref')}
         transit_type_by_id = {vech: d.iloc[0].route_type for vech, d in transit_loc_by_id.items()}
 
         leg_df['time'] = df['epoch_ts'].astype(float)
@@ -0,0 +1,260 @@
+import os
+import shutil
+
+import numpy as np
+from numba import njit
+from shapely import wkb
+
+
+# Kinds of ways in the index and the OSM views they are read from
+CAR_WAYS = 0
+RAIL_WAYS = 1
+# (view, type column)
+WAY_VIEWS = {
+    CAR_WAYS: ('planet_osm_car_ways', 'highway'),
+    RAIL_WAYS: ('planet_osm_rail_ways', 'railway'),
+}
+# Prefixes of the read_locations() columns
+WAY_COLUMNS = {
+    CAR_WAYS: 'closest_car_way',
+    RAIL_WAYS: 'closest_rail_way',
+}
+
+DEFAULT_CELL_SIZE = 100.0
+# Same search radius as in annotate_location_ways.sql
+DEFAULT_MAX_DISTANCE = 50.0
+
+INDEX_ARRAYS = (
+    'x0', 'y0', 'x1', 'y1', 'segment_ways', 'way_ids', 'way_kinds', 'way_names', 'way_types',
+    'cell_keys', 'cell_starts', 'cell_segments', 'grid',
+)
+
+
+@njit(cache=True)
+def _cell_key(cx, cy):
+    return (cx << 32) | cy
+
+
+@njit(cache=True)
+def _assign_cells(x0, y0, x1, y1, origin_x, origin_y, cell_size):
+    # Put every segment in all the cells its bounding box touches
+    n = len(x0)
+    counts = np.empty(n, dtype=np.int64)
+    for i in range(n):
+        cx0 = int((min(x0[i], x1[i]) - origin_x) // cell_size)
+        cx1 = int((max(x0[i], x1[i]) - origin_x) // cell_size)
+        cy0 = int((min(y0[i], y1[i]) - origin_y) // cell_size)
+        cy1 = int((max(y0[i], y1[i]) - origin_y) // cell_size)
+        counts[i] = (cx1 - cx0 + 1) * (cy1 - cy0 + 1)
+
+    keys = np.empty(np.sum(counts), dtype=np.int64)
+    segments = np.empty(len(keys), dtype=np.int64)
+    pos = 0
+    for i in range(n):
+        cx0 = int((min(x0[i], x1[i]) - origin_x) // cell_size)
+        cx1 = int((max(x0[i], x1[i]) - origin_x) // cell_size)
+        cy0 = int((min(y0[i], y1[i]) - origin_y) // cell_size)
+        cy1 = int((max(y0[i], y1[i]) - origin_y) // cell_size)
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                keys[pos] = _cell_key(cx, cy)
+                segments[pos] = i
+                pos += 1
+    return keys, segments
+
+
+@njit(cache=True)
+def _nearest_ways(
+    x, y, max_distance, x0, y0, x1, y1, segment_ways, way_kinds, cell_keys, cell_starts, cell_segments,
+    origin_x, origin_y, cell_size, n_kinds
+):
+    # Returns the distances to the nearest ways and their rows in the way arrays
+    n = len(x)
+    distances = np.full((n, n_kinds), np.inf)
+    ways = np.full((n, n_kinds), -1, dtype=np.int64)
+    reach = int(np.ceil(max_distance / cell_size))
+
+    for i in range(n):
+        if not (np.isfinite(x[i]) and np.isfinite(y[i])):
+            continue
+        cx = int((x[i] - origin_x) // cell_size)
+        cy = int((y[i] - origin_y) // cell_size)
+        for ncx in range(cx - reach, cx + reach + 1):
+            if ncx < 0:
+                continue
+            for ncy in range(cy - reach, cy + reach + 1):
+                if ncy < 0:
+                    continue
+                key = _cell_key(ncx, ncy)
+                cell = np.searchsorted(cell_keys, key)
+                if cell >= len(cell_keys) or cell_keys[cell] != key:
+                    continue
+                for j in range(cell_starts[cell], cell_starts[cell + 1]):
+                    s = cell_segments[j]
+                    # Distance from the point to the segment
+                    dx = x1[s] - x0[s]
+                    dy = y1[s] - y0[s]
+                    length2 = dx * dx + dy * dy
+                    t = 0.0
+                    if length2 > 0:
+                        t = ((x[i] - x0[s]) * dx + (y[i] - y0[s]) * dy) / length2
+                        t = min(max(t, 0.0), 1.0)
+                    px = x0[s] + t * dx - x[i]
+                    py = y0[s] + t * dy - y[i]
+                    d = np.sqrt(px * px + py * py)
+                    k = way_kinds[segment_ways[s]]
+                    if d < distances[i, k]:
+                        distances[i, k] = d
+                        ways[i, k] = segment_ways[s]
+
+    for i in range(n):
+        for k in range(n_kinds):
+            if distances[i, k] > max_distance:
+                distances[i, k] = np.nan
+                ways[i, k] = -1
+    return distances, ways
+
+
+def build_way_index(ways, cell_size=DEFAULT_CELL_SIZE):
+    """Build the index arrays from an iterable of (kind, osm_id, name, type, coords).
+
+    `coords` is an (N, 2) array of the points of a line in the local 2D CRS.
+    """
+    parts = {name: [] for name in ('x0', 'y0', 'x1', 'y1', 'segment_ways')}
+    way_ids, way_kinds, way_names, way_types = [], [], [], []
+    for kind, osm_id, name, way_type, coords in ways:
+        coords = np.asarray(coords, dtype=np.float64)[:, :2]
+        if len(coords) < 2:
+            continue
+        n = len(coords) - 1
+        parts['x0'].append(coords[:-1, 0])
+        parts['y0'].append(coords[:-1, 1])
+        parts['x1'].append(coords[1:, 0])
+        parts['y1'].append(coords[1:, 1])
+        parts['segment_ways'].append(np.full(n, len(way_ids), dtype=np.int64))
+        way_ids.append(osm_id)
+        way_kinds.append(kind)
+        way_names.append(name or '')
+        way_types.append(way_type or '')
+
+    arrays = {}
+    for name, values in parts.items():
+        dtype = np.int64 if name == 'segment_ways' else np.float64
+        arrays[name] = np.concatenate(values).astype(dtype) if values else np.empty(0, dtype=dtype)
+    arrays['way_ids'] = np.array(way_ids, dtype=np.int64)
+    arrays['way_kinds'] = np.array(way_kinds, dtype=np.int64)
+    # Fixed-width unicode arrays, so that they can be memory-mapped too
+    arrays['way_names'] = np.array(way_names, dtype=str)
+    arrays['way_types'] = np.array(way_types, dtype=str)
+
+    if len(arrays['x0']):
+        # Leave one empty cell around the data so that cell numbers stay positive
+        origin_x = min(arrays['x0'].min(), arrays['x1'].min()) - cell_size
+        origin_y = min(arrays['y0'].min(), arrays['y1'].min()) - cell_size
+    else:
+        origin_x = origin_y = 0.0
+    keys, segments = _assign_cells(
+        arrays['x0'], arrays['y0'], arrays['x1'], arrays['y1'], origin_x, origin_y, cell_size
+    )
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    cell_keys, cell_starts = np.unique(keys, return_index=True)
+    arrays['cell_keys'] = cell_keys
+    arrays['cell_starts'] = np.append(cell_starts, len(keys)).astype(np.int64)
+    arrays['cell_segments'] = segments[order]
+    arrays['grid'] = np.array([origin_x, origin_y, cell_size])
+    return WayIndex(arrays)
+
+
+def read_ways(conn):
+    """Read the car and rail ways from the OSM views in the database."""
+    for kind, (view, type_column) in WAY_VIEWS.items():
+        with conn.cursor() as curs:
+            curs.execute(
+                f'SELECT osm_id, name, {type_column}, ST_AsBinary(way) FROM {view} WHERE way IS NOT NULL'
+            )
+            for osm_id, name, way_type, way in curs:
+                geom = wkb.loads(bytes(way))
+                lines = geom.geoms if hasattr(geom, 'geoms') else [geom]
+                for line in lines:
+                    yield kind, osm_id, name, way_type, np.array(line.coords)
+
+
+class WayIndex:
+    """Nearest car and rail way lookups for arrays of points.
+
+    The index is a uniform grid over the segments of the OSM lines. It is
+    stored as a directory of .npy files that are memory-mapped when loaded,
+    so worker processes on the same host share the pages.
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.origin_x, self.origin_y, self.cell_size = (float(x) for x in arrays['grid'])
+
+    @classmethod
+    def load(cls, path):
+        arrays = {name: np.load(os.path.join(path, '%s.npy' % name), mmap_mode='r') for name in INDEX_ARRAYS}
+        return cls(arrays)
+
+    def save(self, path):
+        # Write to a new directory and swap it in place, so that processes
+        # loading the index never see a partially written one.
+        new_path = path + '.new'
+        old_path = path + '.old'
+        shutil.rmtree(new_path, ignore_errors=True)
+        os.makedirs(new_path)
+        for name in INDEX_ARRAYS:
+            np.save(os.path.join(new_path, '%s.npy' % name), self.arrays[name])
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(new_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def nearest_ways(self, x, y, max_distance=DEFAULT_MAX_DISTANCE):
+        """Find the nearest way of each kind within `max_distance` for the points.
+
+        Returns a dict of arrays with the same way columns that
+        read_locations() returns: ids as strings, distances rounded to
+        0.1 m, names and types. Distances are NaN and the other columns
+        None if there is no way near enough.
+        """
+        a = self.arrays
+        distances, ways = _nearest_ways(
+            np.ascontiguousarray(x, dtype=np.float64), np.ascontiguousarray(y, dtype=np.float64),
+            float(max_distance), a['x0'], a['y0'], a['x1'], a['y1'], a['segment_ways'], a['way_kinds'],
+            a['cell_keys'], a['cell_starts'], a['cell_segments'],
+            self.origin_x, self.origin_y, self.cell_size, len(WAY_VIEWS),
+        )
+        out = {}
+        for kind, prefix in WAY_COLUMNS.items():
+            kind_ways = ways[:, kind]
+            found = kind_ways >= 0
+            for col, values in (('id', a['way_ids']), ('name', a['way_names']), ('type', a['way_types'])):
+                col_values = np.full(len(kind_ways), None, dtype=object)
+                col_values[found] = values[kind_ways[found]].astype(str)
+                if col != 'id':
+                    # Missing names and types are stored as empty strings
+                    col_values[col_values == ''] = None
+                out['%s_%s' % (prefix, col)] = col_values
+            out['%s_dist' % prefix] = np.round(distances[:, kind], 1)
+        return out
+
+
+_loaded_indexes = {}
+
+
+def get_way_index(path):
+    """Return the index at `path`, loading it only once per process.
+
+    WayIndex.save() swaps in a new directory, so the index is reloaded
+    when the inode or modification time of the directory changes.
+    """
+    st = os.stat(path)
+    key = (st.st_ino, st.st_mtime_ns)
+    loaded = _loaded_indexes.get(path)
+    if loaded is None or loaded[0] != key:
+        loaded = (key, WayIndex.load(path))
+        _loaded_indexes[path] = loaded
+    return loaded[1]
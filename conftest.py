@@ -3,12 +3,19 @@ import pytest
 from graphene_django.utils.testing import graphql_query
 from pytest_factoryboy import register
 
+from trips.device_cache import device_cache
 from trips.tests import factories as trips_factories
 
 register(trips_factories.DeviceFactory)
 register(trips_factories.TripFactory)
 
 
+@pytest.fixture(autouse=True)
+def clear_device_cache():
+    # Database changes are rolled back between tests without sending signals
+    device_cache.clear()
+
+
 @pytest.fixture
 def graphql_client_query(client):
     def func(*args, **kwargs):
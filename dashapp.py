@@ -19,12 +19,15 @@ from sqlalchemy import create_engine
 
 from utils.perf import PerfCounter
 from calc.trips import (
-    filter_trips, read_locations, read_uuids, split_trip_legs, get_transit_locations, LOCAL_2D_CRS
+    add_way_names, filter_trips, read_locations, read_uuids, split_trip_legs, get_transit_locations, LOCAL_2D_CRS
 )
 
 
 import os; import django; os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mocaf.settings"); django.setup()  # noqa
-from trips.models import Device
+from django.conf import settings
+from calc.wayindex import get_way_index
+from django.db.models import Prefetch
+from trips.models import Device, LegLocation
 
 
 from dotenv import load_dotenv
@@ -237,14 +240,21 @@ def make_trip_component():
     end = df['local_time'].max()
 
     trips = device.trips.all()
-    trips = trips.started_during(start, end).prefetch_related('legs', 'legs__locations')
+    # Only legs generated before the track was stored with the leg need the points
+    old_leg_locations = LegLocation.objects.filter(leg__geometry__isnull=True)
+    trips = trips.started_during(start, end).prefetch_related(
+        'legs', Prefetch('legs__locations', queryset=old_leg_locations)
+    )
     pc.display('fetched %d trips' % len(trips))
 
     recs = []
     for trip in trips:
         legs = list(trip.legs.all())
         for idx, leg in enumerate(legs):
-            path = [[p.loc.x, p.loc.y] for p in leg.locations.all()]
+            if leg.geometry is not None:
+                path = [list(coords) for coords in leg.geometry.coords]
+            else:
+                path = [[p.loc.x, p.loc.y] for p in leg.locations.all()]
             name = 'Trip %d, leg %d/%d: %s' % (trip.id, idx + 1, len(legs), leg.mode.name)
             if leg.user_corrected_mode and leg.estimated_mode:
                 name += ' [%s -> %s]' % (leg.estimated_mode.name, leg.user_corrected_mode.name)
@@ -522,7 +532,10 @@ def render_output(new_path, disable_filters, show_probs):
 
     if locations_uuid is None or locations_uuid != new_uid or filters_enabled != new_filtered:
         pc.display('reading trips for %s' % new_uid)
-        df = read_locations(conn, new_uid, include_all=True, start_time='2022-01-01')
+        way_index = get_way_index(settings.WAY_INDEX_PATH) if settings.WAY_INDEX_PATH else None
+        df = read_locations(conn, new_uid, include_all=True, start_time='2022-01-01', way_index=way_index)
+        if way_index is None:
+            add_way_names(conn, df)
         pc.display('trips read (%d rows)' % len(df))
         df.time = pd.to_datetime(df.time, utc=True)
 
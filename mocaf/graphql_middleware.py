@@ -1,9 +1,13 @@
+from functools import partial
+
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.utils.functional import SimpleLazyObject
 from graphql.error import GraphQLError
 from .graphql_helpers import GraphQLAuthFailedError, GraphQLAuthRequiredError
 from graphql.language.ast import Variable
 
+from trips.device_cache import device_cache
 from trips.models import Device
 from .graphql_types import AuthenticatedDeviceNode
 
@@ -26,7 +30,7 @@ class APITokenMiddleware:
             if arg.name.value == 'uuid':
                 val = _get_arg_value(arg, info)
                 try:
-                    dev = Device.objects.get(uuid=val)
+                    dev = device_cache.get(val)
                 except Device.DoesNotExist:
                     raise GraphQLAuthFailedError("Device not found", [arg])
                 except ValidationError:
@@ -48,7 +52,9 @@ class APITokenMiddleware:
         if not dev.enabled and info.field_name not in ALLOWED_MUTATIONS_WHEN_DISABLED:
             raise GraphQLAuthFailedError("Mocaf disabled", [directive])
 
-        info.context.device = dev
+        # The authentication was done using the cached fields; the device
+        # itself is loaded only if a resolver needs it.
+        info.context.device = SimpleLazyObject(partial(Device.objects.get, id=dev.id))
 
     def resolve(self, next, root, info, **kwargs):
         context = info.context
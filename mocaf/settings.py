@@ -47,6 +47,11 @@ env = environ.Env(
     INTERNAL_IPS=(list, []),
     PROMETHEUS_METRICS_AUTH_TOKEN=(str, None),
     PROMETHEUS_EXPORT_MIGRATIONS=(bool, False),
+    INGEST_BATCH_SIZE=(int, 100),
+    INGEST_LOCATIONS_DIRECTLY=(bool, False),
+    GENERATE_TRIPS_IN_PARALLEL=(bool, False),
+    WAY_INDEX_PATH=(str, ''),
+    LEG_SIMPLIFY_TOLERANCE=(float, 5.0),
 )
 PROMETHEUS_EXPORT_MIGRATIONS = env('PROMETHEUS_EXPORT_MIGRATIONS')
 
@@ -340,6 +345,32 @@ LOCAL_SRS = 3067  # ETRS-TM35-FIN
 # How many hours a trip leg is editable by the user
 ALLOWED_TRIP_UPDATE_HOURS = 3 * 24
 
+# How many received events to import in one batch. If set to zero,
+# the events are imported one at a time.
+INGEST_BATCH_SIZE = env('INGEST_BATCH_SIZE')
+# If set, location uploads are saved already when they are received instead
+# of waiting for the import task. The raw uploads are stored in any case.
+INGEST_LOCATIONS_DIRECTLY = env('INGEST_LOCATIONS_DIRECTLY')
+
+# If set, the periodic trip generation task only finds the devices with new
+# samples and queues a separate task for each of them.
+GENERATE_TRIPS_IN_PARALLEL = env('GENERATE_TRIPS_IN_PARALLEL')
+
+# Directory of the nearest way index built with the build_way_index
+# management command. If set, trip generation looks up the nearest car
+# and rail ways in-process instead of in the database.
+WAY_INDEX_PATH = env('WAY_INDEX_PATH')
+
+# Samples of generated legs that are closer than this (in meters) to the
+# simplified track are left out of the tracks stored with the legs
+# (Leg.geometry). The leg locations keep all the samples. Set to 0 to store
+# all the samples in the tracks too.
+LEG_SIMPLIFY_TOLERANCE = env('LEG_SIMPLIFY_TOLERANCE')
+
+# How many seconds device information is cached in each process
+DEVICE_CACHE_TTL = 60
+DEVICE_CACHE_SIZE = 10000
+
 # Notification engine
 GENIEM_NOTIFICATION_API_BASE = env('GENIEM_NOTIFICATION_API_BASE')
 GENIEM_NOTIFICATION_API_TOKEN = env('GENIEM_NOTIFICATION_API_TOKEN')
@@ -9,12 +9,11 @@ import requests
 from psycopg2.extras import execute_values
 from django.db import transaction, connection
 from django.conf import settings
-from django.contrib.gis.geos import Point
-from django.contrib.gis.gdal import CoordTransform, SpatialReference
 
 from transitrt.models import VehicleLocation
 from trips.models import TransportMode
 from gtfs.models import FeedInfo, Route
+from utils.geo import transform_coords
 from .exceptions import CommonTaskFailure
 
 
@@ -24,11 +23,6 @@ MAX_TIME_IN_PAST = 120  # s
 
 LOCAL_TZ = pytz.timezone('Europe/Helsinki')
 
-GPS_SRS = SpatialReference('WGS84')
-LOCAL_SRS = SpatialReference(settings.LOCAL_SRS)
-
-gps_to_local = CoordTransform(GPS_SRS, LOCAL_SRS)
-
 
 class TransitRTImporter:
     ROUTE_TYPE_TRAM = 0
@@ -149,15 +143,15 @@ class TransitRTImporter:
         table_name = VehicleLocation._meta.db_table
         local_srs = settings.LOCAL_SRS
 
-        # Reuse the same point object for better performance
-        point = Point(x=0, y=0, srid=4326)
+        # Transform all the coordinates in one call for better performance
+        xs, ys = transform_coords(
+            [obj['loc']['lon'] for obj in objs], [obj['loc']['lat'] for obj in objs],
+            4326, local_srs
+        )
 
-        for obj in objs:
-            point.x = obj['loc']['lon']
-            point.y = obj['loc']['lat']
-            point.transform(gps_to_local)
-            obj['x'] = point.x
-            obj['y'] = point.y
+        for obj, x, y in zip(objs, xs, ys):
+            obj['x'] = float(x)
+            obj['y'] = float(y)
             obj['gtfs_feed'] = self.gtfs_feed.pk
             if 'bearing' not in obj:
                 obj['bearing'] = None
@@ -16,7 +16,9 @@ class TripsConfig(AppConfig):
     verbose_name = _('Trips')
 
     def ready(self):
-        """Set up Prometheus gauges."""
+        """Connect signal handlers and set up Prometheus gauges."""
+        from . import device_cache  # noqa
+
         # Don't do this in management commands other than runserver
         # https://stackoverflow.com/questions/65072296/django-execute-code-only-for-manage-py-runserver-not-for-migrate-help-e
         is_manage_py = any(arg.endswith("manage.py") for arg in sys.argv)
@@ -0,0 +1,106 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from functools import partial
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+
+# Device fields needed on the hot paths (ingest and GraphQL authentication)
+CACHED_FIELDS = (
+    'id', 'uuid', 'token', 'enabled_at', 'debug_log_level', 'custom_config', 'debugging_enabled_at',
+    'platform', 'system_version', 'brand', 'model',
+)
+
+CachedDevice = namedtuple('CachedDevice', CACHED_FIELDS + ('enabled',))
+
+
+class DeviceCache:
+    """Per-process TTL/LRU cache of the hot-path fields of devices, keyed by uuid.
+
+    Entries are invalidated when a device is saved or deleted in this process.
+    Changes made by other processes become visible after `ttl` seconds.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def _make_key(self, uid):
+        if uid is None:
+            return None
+        if isinstance(uid, uuid.UUID):
+            return uid
+        try:
+            return uuid.UUID(str(uid))
+        except ValueError:
+            raise ValidationError('Invalid UUID')
+
+    def _fetch(self, key):
+        from .models import Device
+
+        row = Device.objects.filter(uuid=key).values_list(*CACHED_FIELDS).first()
+        if row is None:
+            raise Device.DoesNotExist('Device %s not found' % key)
+        dev = dict(zip(CACHED_FIELDS, row))
+        return CachedDevice(enabled=dev['enabled_at'] is not None, **dev)
+
+    def get(self, uid) -> CachedDevice:
+        """Return the cached device for `uid`.
+
+        Raises Device.DoesNotExist if the device is not found and
+        ValidationError if `uid` is not a valid uuid.
+        """
+        from .models import Device
+
+        key = self._make_key(uid)
+        if key is None:
+            raise Device.DoesNotExist('Device uuid missing')
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, dev = entry
+                if expires_at > now:
+                    self.entries.move_to_end(key)
+                    return dev
+                del self.entries[key]
+
+        dev = self._fetch(key)
+        with self.lock:
+            self.entries[key] = (now + self.ttl, dev)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return dev
+
+    def invalidate(self, uid):
+        try:
+            key = self._make_key(uid)
+        except ValidationError:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+device_cache = DeviceCache(ttl=settings.DEVICE_CACHE_TTL, max_size=settings.DEVICE_CACHE_SIZE)
+
+
+@receiver(post_save, sender='trips.Device')
+@receiver(post_delete, sender='trips.Device')
+def invalidate_device(sender, instance, **kwargs):
+    device_cache.invalidate(instance.uuid)
+    # Make sure the entry is not refilled with data from before the commit
+    transaction.on_commit(partial(device_cache.invalidate, instance.uuid))
@@ -1,27 +1,129 @@
-from datetime import timedelta
+import io
 import logging
+import math
+from datetime import datetime
 import sentry_sdk
 import geopandas as gpd
+import numpy as np
 
+from calc.dragimm import FilterState
+from calc.pgcopy import encode_copy_binary
+from calc.wayindex import get_way_index
 from calc.trips import (
-    LOCAL_2D_CRS, read_locations, read_uuids, split_trip_legs, filter_trips
+    LOCAL_2D_CRS, epoch_seconds, read_locations_chunked, read_uuids, simplify_legs, split_trip_legs,
+    filter_trips, filter_trips_batched
 )
 
 from utils.perf import PerfCounter
+from django.conf import settings
 from django.db import transaction, connection
-from django.db.models import Q, Max
+from django.db.models import Max
 from django.contrib.gis.gdal import SpatialReference, CoordTransform
-from django.contrib.gis.geos import Point
+from django.contrib.gis.geos import LineString, Point
 from django.utils import timezone
-from psycopg2.extras import execute_values
-from trips.models import Device, TransportMode, Trip, Leg, LegLocation
-from trips_ingest.models import Location
+from analytics.models import TripSummary
+from feedback.models import DeviceFeedback
+from trips.models import Device, DeviceProcessingState, TransportMode, Trip, Leg, LegLocation, UserLegUpdate
 
 
 logger = logging.getLogger(__name__)
 
 LEG_LOCATION_TABLE = LegLocation._meta.db_table
 
+# Finds the trips of a device with legs overlapping the given time range
+# and, unless they have been corrected by the user (or `force` is set),
+# deletes them with everything that refers to them. The ORM would load
+# all the related rows into Python to emulate the cascades.
+#
+# The statement mirrors these on_delete relations, so it has to be kept
+# in sync with them:
+#   LegLocation.leg     CASCADE
+#   UserLegUpdate.leg   CASCADE
+#   DeviceFeedback.leg  SET_NULL
+#   DeviceFeedback.trip SET_NULL
+#   TripSummary.trip    CASCADE
+#   Leg.trip            CASCADE
+DELETE_OVERLAPPING_TRIPS_SQL = f'''
+    WITH overlapping_legs AS (
+        SELECT leg.id, leg.trip_id, leg.user_corrected_mode_id, leg.user_corrected_mode_variant_id
+        FROM {Leg._meta.db_table} AS leg
+        JOIN {Trip._meta.db_table} AS trip ON trip.id = leg.trip_id
+        WHERE
+            trip.device_id = %(device_id)s
+            AND (
+                (leg.end_time >= %(min_time)s AND leg.end_time <= %(max_time)s)
+                OR (leg.start_time >= %(min_time)s AND leg.start_time <= %(max_time)s)
+            )
+    ),
+    overlapping_trips AS (
+        SELECT DISTINCT trip_id AS id FROM overlapping_legs
+    ),
+    corrections AS (
+        SELECT
+            EXISTS (
+                SELECT 1 FROM overlapping_legs AS leg
+                WHERE
+                    leg.user_corrected_mode_id IS NOT NULL
+                    OR leg.user_corrected_mode_variant_id IS NOT NULL
+                    OR EXISTS (SELECT 1 FROM {DeviceFeedback._meta.db_table} AS fb WHERE fb.leg_id = leg.id)
+            ) AS legs_corrected,
+            EXISTS (
+                SELECT 1 FROM {DeviceFeedback._meta.db_table} AS fb
+                JOIN overlapping_trips AS trip ON fb.trip_id = trip.id
+            ) AS trips_corrected
+    ),
+    deletable_trips AS (
+        SELECT trip.id FROM overlapping_trips AS trip, corrections
+        WHERE %(force)s OR NOT (corrections.legs_corrected OR corrections.trips_corrected)
+    ),
+    deletable_legs AS (
+        SELECT leg.id FROM {Leg._meta.db_table} AS leg JOIN deletable_trips AS trip ON leg.trip_id = trip.id
+    ),
+    deleted_locations AS (
+        DELETE FROM {LEG_LOCATION_TABLE} AS loc USING deletable_legs AS leg
+        WHERE loc.leg_id = leg.id
+        RETURNING 1
+    ),
+    deleted_leg_updates AS (
+        DELETE FROM {UserLegUpdate._meta.db_table} AS upd USING deletable_legs AS leg
+        WHERE upd.leg_id = leg.id
+    ),
+    unlinked_feedbacks AS (
+        -- One statement can't update the same row twice
+        UPDATE {DeviceFeedback._meta.db_table} AS fb
+        SET
+            leg_id = CASE WHEN fb.leg_id IN (SELECT id FROM deletable_legs) THEN NULL ELSE fb.leg_id END,
+            trip_id = CASE WHEN fb.trip_id IN (SELECT id FROM deletable_trips) THEN NULL ELSE fb.trip_id END
+        WHERE
+            fb.leg_id IN (SELECT id FROM deletable_legs)
+            OR fb.trip_id IN (SELECT id FROM deletable_trips)
+    ),
+    deleted_summaries AS (
+        DELETE FROM {TripSummary._meta.db_table} AS summary USING deletable_trips AS trip
+        WHERE summary.trip_id = trip.id
+    ),
+    deleted_legs AS (
+        DELETE FROM {Leg._meta.db_table} AS leg USING deletable_legs AS d
+        WHERE leg.id = d.id
+        RETURNING 1
+    ),
+    deleted_trips AS (
+        DELETE FROM {Trip._meta.db_table} AS trip USING deletable_trips AS d
+        WHERE trip.id = d.id
+        RETURNING 1
+    )
+    SELECT
+        corrections.legs_corrected,
+        corrections.trips_corrected,
+        (SELECT COUNT(*) FROM deleted_trips),
+        (SELECT COUNT(*) FROM deleted_legs),
+        (SELECT COUNT(*) FROM deleted_locations)
+    FROM corrections
+'''
+
+# First key of the advisory locks taken for devices being processed
+DEVICE_LOCK_CLASS = 0x7472  # 'tr'
+
 local_crs = SpatialReference(LOCAL_2D_CRS)
 gps_crs = SpatialReference(4326)
 coord_transform = CoordTransform(local_crs, gps_crs)
@@ -34,16 +136,6 @@ def make_point(x, y):
     return pnt
 
 
-def generate_leg_location_rows(leg, df):
-    rows = df.apply(lambda row: (
-        leg.id,
-        row.lon, row.lat,
-        '%s' % str(row.time),
-        row.speed,
-    ), axis=1)
-    return list(rows.values)
-
-
 class GeneratorError(Exception):
     pass
 
@@ -63,29 +155,26 @@ class TripGenerator:
             'train': transport_modes['train'],
         }
 
-    def insert_leg_locations(self, rows):
+    def insert_leg_locations(self, leg_ids, lon, lat, time, speed):
         pc = PerfCounter('save_locations', show_time_to_last=True)
-        query = f'''INSERT INTO {LEG_LOCATION_TABLE} (
-            leg_id, loc, time, speed
-        ) VALUES %s'''
-
+        data = encode_copy_binary([
+            # leg_id is an int4 foreign key
+            ('int4', leg_ids),
+            ('point', (lon, lat, 4326)),
+            ('timestamptz', time),
+            ('float8', speed),
+        ])
+        pc.display('encoded %d rows' % len(leg_ids))
+
+        query = f'COPY {LEG_LOCATION_TABLE} (leg_id, loc, time, speed) FROM STDIN (FORMAT binary)'
         with connection.cursor() as cursor:
-            pc.display('after cursor')
-            value_template = """(
-                    %s,
-                    ST_SetSRID(ST_MakePoint(%s, %s), 4326),
-                    %s :: timestamptz,
-                    %s
-            )"""
-            execute_values(
-                cursor, query, rows, template=value_template, page_size=10000
-            )
+            cursor.copy_expert(query, io.BytesIO(data))
 
         pc.display('after insert')
 
-    def save_leg(self, trip, df, last_ts, default_variants, pc):
-        start = df.iloc[0][['time', 'x', 'y']]
-        end = df.iloc[-1][['time', 'x', 'y']]
+    def build_leg(self, trip, df, last_ts, default_variants, simplification_error=None):
+        start = df.iloc[0][['time', 'lon', 'lat']]
+        end = df.iloc[-1][['time', 'lon', 'lat']]
         received_at = df.iloc[-1].created_at
 
         leg_length = df['distance'].sum()
@@ -96,6 +185,12 @@ class TripGenerator:
         mode = self.atype_to_mode[df.iloc[0].atype]
         variant = default_variants.get(mode)
 
+        geometry = time_deltas = None
+        if len(df) >= 2:
+            geometry = LineString(df[['lon', 'lat']].to_numpy(dtype='float64'), srid=4326)
+            ms = df['time'].dt.tz_convert(None).to_numpy(dtype='datetime64[ms]').astype('int64')
+            time_deltas = np.diff(ms, prepend=ms[0]).tolist()
+
         leg = Leg(
             trip=trip,
             mode=mode,
@@ -104,16 +199,17 @@ class TripGenerator:
             length=leg_length,
             start_time=start.time,
             end_time=end.time,
-            start_loc=make_point(start.x, start.y),
-            end_loc=make_point(end.x, end.y),
+            # The samples have already been transformed to GPS coordinates
+            start_loc=Point(start.lon, start.lat, srid=4326),
+            end_loc=Point(end.lon, end.lat, srid=4326),
+            geometry=geometry,
+            location_time_deltas=time_deltas,
+            simplification_error=simplification_error,
             received_at=received_at,
         )
         leg.update_carbon_footprint()
-        leg.save()
-        rows = generate_leg_location_rows(leg, df)
-        pc.display(str(leg))
 
-        return rows, end.time
+        return leg, end.time
 
     def save_trip(self, device, df, default_variants):
         pc = PerfCounter('generate_trips', show_time_to_last=True)
@@ -133,56 +229,70 @@ class TripGenerator:
         df['lat'] = df.geometry.y
         pc.display('after crs for %d points' % len(df))
 
+        # Only the tracks stored with the legs are simplified, the leg
+        # locations keep all the samples.
+        track_df = df
+        simplification_errors = {}
+        if settings.LEG_SIMPLIFY_TOLERANCE:
+            track_df, simplification_errors = simplify_legs(df, settings.LEG_SIMPLIFY_TOLERANCE)
+            pc.display('simplified %d samples to %d' % (len(df), len(track_df)))
+
         # Delete trips that overlap with our data
-        overlap = Q(end_time__gte=min_time) & Q(end_time__lte=max_time)
-        overlap |= Q(start_time__gte=min_time) & Q(start_time__lte=max_time)
-        legs = Leg.objects.filter(trip__device=device).filter(overlap)
+        with connection.cursor() as cursor:
+            cursor.execute(DELETE_OVERLAPPING_TRIPS_SQL, dict(
+                device_id=device.id, min_time=min_time, max_time=max_time, force=self.force,
+            ))
+            legs_corrected, trips_corrected, *counts = cursor.fetchone()
 
         if not self.force:
-            if legs.filter(
-                Q(feedbacks__isnull=False) | Q(user_corrected_mode__isnull=False) | Q(user_corrected_mode_variant__isnull=False)
-            ).exists():
+            if legs_corrected:
                 logger.info('Legs have user corrected elements, not deleting')
-                return
-
-        if not self.force:
-            if device.trips.filter(legs__in=legs).filter(feedbacks__isnull=False):
+                return False
+            if trips_corrected:
                 logger.info('Trips have user corrected elements, not deleting')
-                return
+                return False
 
-        count = device.trips.filter(legs__in=legs).delete()
-        print(count)
-        pc.display('deleted')
+        pc.display('deleted %d trips, %d legs and %d leg locations' % tuple(counts))
 
         last_ts = df.time.min()
 
         # Create trips
-        all_rows = []
-
         trip = Trip(device=device)
         trip.save()
         pc.display('trip %d saved' % trip.id)
 
-        leg_ids = df.leg_id.unique()
-        for leg_id in leg_ids:
-            leg_df = df[df.leg_id == leg_id]
-            leg_rows, last_ts = self.save_leg(trip, leg_df, last_ts, default_variants, pc)
-            all_rows += leg_rows
-
-        pc.display('generated %d legs' % len(leg_ids))
-        self.insert_leg_locations(all_rows)
+        leg_dfs = dict(list(track_df.groupby('leg_id', sort=False)))
+        legs = []
+        for leg_id, leg_df in leg_dfs.items():
+            leg, last_ts = self.build_leg(
+                trip, leg_df, last_ts, default_variants, simplification_errors.get(leg_id)
+            )
+            legs.append(leg)
+        Leg.objects.bulk_create(legs)
+        pc.display('saved %d legs' % len(legs))
+
+        leg_ids = df['leg_id'].map(dict(zip(leg_dfs.keys(), (leg.id for leg in legs))))
+        self.insert_leg_locations(
+            leg_ids=leg_ids.to_numpy(dtype='int64'),
+            lon=df['lon'].to_numpy(dtype='float64'),
+            lat=df['lat'].to_numpy(dtype='float64'),
+            time=df['time'],
+            speed=df['speed'].to_numpy(dtype='float64', na_value=np.nan),
+        )
         pc.display('updating carbon footprint')
         trip.update_device_carbon_footprint()
         pc.display('trip %d save done' % trip.id)
+        return True
 
     def begin(self):
         transaction.set_autocommit(False)
 
-    def process_trip(self, device, df):
+    def process_trip(self, device, df, filter_state=None, filtered=False):
         pc = PerfCounter('process_trip')
         logger.info('%s: %s: trip with %d samples' % (str(device), df.time.min(), len(df)))
-        df = filter_trips(df)
-        pc.display('filter done')
+        if not filtered:
+            df = filter_trips(df, filter_state=filter_state)
+            pc.display('filter done')
 
         # Use the fixed versions of columns
         df['atype'] = df['atypef']
@@ -193,12 +303,31 @@ class TripGenerator:
         pc.display('legs split')
         if df is None:
             logger.info('%s: No legs for trip' % str(device))
-            return
+            return False
         with transaction.atomic():
-            self.save_trip(device, df, device._default_variants)
+            saved = self.save_trip(device, df, device._default_variants)
         pc.display('trip saved')
+        return saved
 
-    def generate_trips(self, uuid, start_time, end_time):
+    def lock_device(self, uuid):
+        """Take a transaction-level advisory lock for processing the device.
+
+        Returns False if another process is already generating trips for it.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_try_advisory_xact_lock(%s, hashtext(%s))', [DEVICE_LOCK_CLASS, str(uuid)]
+            )
+            return cursor.fetchone()[0]
+
+    def generate_trips(self, uuid, start_time, end_time, commit=True, filter_state=None):
+        """Generate trips for a device from the samples between start_time and end_time.
+
+        If `filter_state` is given, only the samples after it are processed,
+        filtering continues from it and the state at the end of the last
+        saved trip is stored as the new checkpoint of the device. The samples
+        of trips that were not saved are then read again on the next run.
+        """
         device = Device.objects.filter(uuid=uuid).first()
         if device is None:
             raise GeneratorError('Device %s not found' % uuid)
@@ -207,72 +336,113 @@ class TripGenerator:
         device._default_variants = {x.mode: x.variant for x in device.default_mode_variants.all()}
 
         pc = PerfCounter('update trips for %s' % uuid, show_time_to_last=True)
-        df = read_locations(connection, uuid, start_time=start_time, end_time=end_time)
-        if df is None or not len(df):
+        way_index = get_way_index(settings.WAY_INDEX_PATH) if settings.WAY_INDEX_PATH else None
+        chunks = read_locations_chunked(
+            connection, uuid, start_time=start_time, end_time=end_time, way_index=way_index
+        )
+        checkpoint = filter_state.copy() if filter_state is not None else None
+        found_samples = False
+        for df in chunks:
+            if filter_state is not None and filter_state.time is not None:
+                # Samples up to the checkpoint have been processed already
+                df = df[epoch_seconds(df.time) > filter_state.time]
+            if not len(df):
+                continue
+            found_samples = True
+            pc.display('read done, got %d rows' % len(df))
+
+            # Without a checkpoint the trips are independent, so filter the
+            # trips of the chunk in one go.
+            filtered = filter_state is None
+            if filtered:
+                df = filter_trips_batched(df)
+                pc.display('filtered %d trips' % df.trip_id.nunique())
+
+            for trip_id in df.trip_id.unique():
+                trip_df = df[df.trip_id == trip_id].copy()
+                with sentry_sdk.configure_scope() as scope:
+                    scope.set_tag('start_time', trip_df.time.min().isoformat())
+                    scope.set_tag('end_time', trip_df.time.max().isoformat())
+                    saved = self.process_trip(device, trip_df, filter_state=filter_state, filtered=filtered)
+                    scope.clear()
+                if saved and filter_state is not None:
+                    checkpoint = filter_state.copy()
+        if not found_samples:
             return
-        pc.display('read done, got %d rows' % len(df))
-
-        for trip_id in df.trip_id.unique():
-            trip_df = df[df.trip_id == trip_id].copy()
-            with sentry_sdk.configure_scope() as scope:
-                scope.set_tag('start_time', trip_df.time.min().isoformat())
-                scope.set_tag('end_time', trip_df.time.max().isoformat())
-                self.process_trip(device, trip_df)
-                scope.clear()
-        transaction.commit()
+        self.update_processing_state(device, checkpoint)
+        if commit:
+            transaction.commit()
         pc.display('trips generated')
         sentry_sdk.set_tag('uuid', None)
 
-    def find_uuids_with_new_samples(self):
-        one_week_ago = timezone.now() - timedelta(days=7)
-        devices = (
-            Device.objects.annotate(
-                last_leg_received_at=Max('trips__legs__received_at'),
-                last_leg_end_time=Max('trips__legs__end_time')
-            ).values('uuid', 'last_leg_received_at', 'last_leg_end_time').exclude(last_leg_received_at=None)
-        )
-        last_leg_by_uuid = {
-            x['uuid']: dict(received_at=x['last_leg_received_at'], end_time=x['last_leg_end_time'])
-            for x in devices
-        }
-        uuids = (
-            Location.objects
-            .filter(deleted_at__isnull=True, time__gte=one_week_ago)
-            .values('uuid').annotate(newest_created_at=Max('created_at')).order_by()
-            .values('uuid', 'newest_created_at')
-        )
-        uuids_to_process = []
-        for row in uuids:
-            uuid = row['uuid']
-            newest_created_at = row['newest_created_at']
-
-            last_leg = last_leg_by_uuid.get(uuid)
-            if not last_leg or newest_created_at > last_leg['received_at']:
-                uuids_to_process.append([
-                    uuid,
-                    last_leg['end_time'] if last_leg else None
-                ])
-
-        return uuids_to_process
+    def update_processing_state(self, device, filter_state=None):
+        last_leg_end = Leg.objects.filter(trip__device=device).aggregate(end_time=Max('end_time'))['end_time']
+        defaults = dict(last_leg_end=last_leg_end)
+        if filter_state is not None and filter_state.time is not None:
+            defaults['filter_state'] = filter_state.to_dict()
+        DeviceProcessingState.objects.update_or_create(uuid=device.uuid, defaults=defaults)
+
+    def mark_samples_processed(self, uuid, sample_created_at):
+        DeviceProcessingState.objects.filter(uuid=uuid).update(last_processed_created_at=sample_created_at)
+
+    def find_devices_with_new_samples(self):
+        return list(DeviceProcessingState.objects.with_new_samples())
+
+    def _get_filter_state(self, state):
+        filter_state = FilterState()
+        if state.filter_state:
+            filter_state = FilterState.from_dict(state.filter_state)
+            # Trips might have been regenerated after the checkpoint was
+            # taken, so use it only if it's not older than the latest leg.
+            checkpoint_time = datetime.fromtimestamp(filter_state.time, tz=timezone.utc)
+            if state.last_leg_end is not None and checkpoint_time < state.last_leg_end:
+                filter_state = FilterState()
+        return filter_state
+
+    def _get_time_range(self, last_leg_end, filter_state):
+        if filter_state.time is not None:
+            # The samples after the checkpoint are filtered out after reading
+            start_time = datetime.fromtimestamp(math.floor(filter_state.time), tz=timezone.utc)
+            return start_time, timezone.now()
+        if last_leg_end:
+            return last_leg_end, timezone.now()
+        return None, None
+
+    def _generate_new_trips_from_state(self, state):
+        filter_state = self._get_filter_state(state)
+        start_time, end_time = self._get_time_range(state.last_leg_end, filter_state)
+        try:
+            self.generate_trips(
+                state.uuid, start_time=start_time, end_time=end_time, commit=False, filter_state=filter_state
+            )
+        except GeneratorError as e:
+            sentry_sdk.capture_exception(e)
+        self.mark_samples_processed(state.uuid, state.last_sample_created_at)
 
     def generate_new_trips(self, only_uuid=None):
-        uuids = self.find_uuids_with_new_samples()
-        now = timezone.now()
-        for uuid, last_leg_end in uuids:
+        states = self.find_devices_with_new_samples()
+        for state in states:
             if only_uuid is not None:
-                if str(uuid) != only_uuid:
+                if str(state.uuid) != only_uuid:
                     continue
-            if last_leg_end:
-                start_time = last_leg_end
-                end_time = now
-            else:
-                start_time = None
-                end_time = None
-
-            try:
-                self.generate_trips(uuid, start_time=start_time, end_time=end_time)
-            except GeneratorError as e:
-                sentry_sdk.capture_exception(e)
+            self.generate_new_trips_for_device(state.uuid)
+            transaction.commit()
+
+    def generate_new_trips_for_device(self, uuid):
+        """Generate trips from the new samples of one device in a transaction of its own.
+
+        The advisory lock makes sure one device is never processed twice at
+        the same time, also when the work is fanned out to several workers.
+        """
+        with transaction.atomic():
+            if not self.lock_device(uuid):
+                logger.info('%s: trips already being generated, skipping' % uuid)
+                return
+            state = DeviceProcessingState.objects.with_new_samples().filter(uuid=uuid).first()
+            if state is None:
+                logger.info('%s: no new samples' % uuid)
+                return
+            self._generate_new_trips_from_state(state)
 
     def end(self):
         transaction.commit()
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from calc.wayindex import DEFAULT_CELL_SIZE, build_way_index, read_ways
+from utils.perf import PerfCounter
+
+
+class Command(BaseCommand):
+    help = 'Build the nearest way index from the OSM car and rail way views'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', type=str, help='Output directory (defaults to WAY_INDEX_PATH)')
+        parser.add_argument('--cell-size', type=float, default=DEFAULT_CELL_SIZE, help='Grid cell size in meters')
+
+    def handle(self, *args, **options):
+        path = options['path'] or settings.WAY_INDEX_PATH
+        if not path:
+            raise CommandError('Give --path or set WAY_INDEX_PATH')
+
+        pc = PerfCounter('build_way_index')
+        index = build_way_index(read_ways(connection), cell_size=options['cell_size'])
+        pc.display('index built')
+        index.save(path)
+        pc.display('index saved')
+        self.stdout.write('%d segments in %d cells saved to %s' % (
+            len(index.arrays['x0']), len(index.arrays['cell_keys']), path
+        ))
+        self.stdout.write('Running processes switch to the new index on their next lookup')
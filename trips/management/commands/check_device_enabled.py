@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+
+from trips.models import Device, EnableEvent
+
+
+class Command(BaseCommand):
+    help = 'Check that enabled_at and disabled_at of devices match their latest enable events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Repair the inconsistent devices')
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        latest_events = EnableEvent.objects.filter(device=OuterRef('pk')).order_by('-time')
+        devices = Device.objects.annotate(
+            latest_event_enabled=Subquery(latest_events.values('enabled')[:1]),
+            latest_event_time=Subquery(latest_events.values('time')[:1]),
+        ).only('uuid', 'enabled_at', 'disabled_at')
+
+        count = 0
+        for dev in devices:
+            if dev.latest_event_time is None:
+                expected = (None, None)
+            elif dev.latest_event_enabled:
+                expected = (dev.latest_event_time, None)
+            else:
+                expected = (None, dev.latest_event_time)
+
+            if (dev.enabled_at, dev.disabled_at) == expected:
+                continue
+
+            count += 1
+            self.stdout.write('%s: enabled_at %s, disabled_at %s (expected %s, %s)' % (
+                dev.uuid, dev.enabled_at, dev.disabled_at, *expected
+            ))
+            if options['fix']:
+                dev.enabled_at, dev.disabled_at = expected
+                dev.save(update_fields=['enabled_at', 'disabled_at'])
+
+        if options['fix']:
+            self.stdout.write('%d devices repaired' % count)
+        else:
+            self.stdout.write('%d inconsistent devices found' % count)
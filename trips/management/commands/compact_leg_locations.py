@@ -0,0 +1,75 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from trips.models import Leg, LegLocation
+
+
+LEG_TABLE = Leg._meta.db_table
+LOC_TABLE = LegLocation._meta.db_table
+
+BACKFILL_SQL = f"""
+    UPDATE {LEG_TABLE} AS leg
+    SET
+        geometry = track.geometry,
+        location_time_deltas = track.time_deltas
+    FROM (
+        SELECT
+            leg_id,
+            ST_MakeLine(loc ORDER BY time) AS geometry,
+            array_agg(time_delta ORDER BY time) AS time_deltas
+        FROM (
+            SELECT
+                leg_id, loc, time,
+                COALESCE(
+                    ROUND(EXTRACT(EPOCH FROM time - LAG(time) OVER (PARTITION BY leg_id ORDER BY time)) * 1000),
+                    0
+                ) :: integer AS time_delta
+            FROM {LOC_TABLE}
+            WHERE leg_id = ANY(%(leg_ids)s)
+        ) AS loc
+        GROUP BY leg_id
+        HAVING COUNT(*) >= 2
+    ) AS track
+    WHERE leg.id = track.leg_id
+"""
+
+
+class Command(BaseCommand):
+    help = 'Store the tracks of old legs with the legs and delete the points of expired legs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Legs to update per transaction')
+        parser.add_argument(
+            '--prune', action='store_true',
+            help='Delete the LegLocation rows of legs that can no longer be updated and have a stored track'
+        )
+
+    def backfill(self, batch_size):
+        total = 0
+        last_id = 0
+        while True:
+            # Legs with less than two points are left without a track, so
+            # walk through the legs by id instead of repeating the same query.
+            leg_ids = list(
+                Leg.objects.filter(geometry__isnull=True, id__gt=last_id)
+                .order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            if not leg_ids:
+                break
+            last_id = leg_ids[-1]
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(BACKFILL_SQL, dict(leg_ids=leg_ids))
+                total += cursor.rowcount
+            self.stdout.write('%d legs updated' % total)
+        return total
+
+    def handle(self, *args, **options):
+        total = self.backfill(options['batch_size'])
+        self.stdout.write('Stored the tracks of %d legs' % total)
+
+        if options['prune']:
+            # The points of expired legs are not served anymore, and the
+            # analytics read the stored tracks.
+            locs = LegLocation.objects.expired().filter(leg__geometry__isnull=False)
+            count, _ = locs.delete()
+            self.stdout.write('Deleted %d leg locations' % count)
@@ -0,0 +1,40 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0026_device_account_key'),
+        ('trips_ingest', '0015_add_location_deleted_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceProcessingState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uuid', models.UUIDField(unique=True)),
+                ('last_sample_created_at', models.DateTimeField(db_index=True, null=True)),
+                ('last_processed_created_at', models.DateTimeField(null=True)),
+                ('last_leg_end', models.DateTimeField(null=True)),
+            ],
+        ),
+        # Initialize the watermarks from the legs and the recent samples
+        # the same way the generator used to find devices with new samples.
+        migrations.RunSQL("""
+            INSERT INTO trips_deviceprocessingstate (uuid, last_processed_created_at, last_leg_end)
+                SELECT d.uuid, MAX(l.received_at), MAX(l.end_time)
+                FROM trips_device AS d
+                INNER JOIN trips_trip AS t ON t.device_id = d.id
+                INNER JOIN trips_leg AS l ON l.trip_id = t.id
+                GROUP BY d.uuid
+                HAVING MAX(l.received_at) IS NOT NULL;
+
+            INSERT INTO trips_deviceprocessingstate (uuid, last_sample_created_at)
+                SELECT uuid, MAX(created_at)
+                FROM trips_ingest_location
+                WHERE deleted_at IS NULL AND time >= NOW() - interval '7 days'
+                GROUP BY uuid
+            ON CONFLICT (uuid) DO UPDATE SET last_sample_created_at = EXCLUDED.last_sample_created_at;
+        """, reverse_sql=migrations.RunSQL.noop),
+    ]
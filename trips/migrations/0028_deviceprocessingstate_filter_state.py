@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0027_add_device_processing_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deviceprocessingstate',
+            name='filter_state',
+            field=models.JSONField(null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+import django.contrib.gis.db.models.fields
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0028_deviceprocessingstate_filter_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='leg',
+            name='geometry',
+            field=django.contrib.gis.db.models.fields.LineStringField(null=True, srid=4326),
+        ),
+        migrations.AddField(
+            model_name='leg',
+            name='location_time_deltas',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), null=True, size=None),
+        ),
+    ]
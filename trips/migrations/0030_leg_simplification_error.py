@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0029_leg_geometry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='leg',
+            name='simplification_error',
+            field=models.FloatField(
+                help_text='Largest distance in m of a dropped sample from the stored track', null=True
+            ),
+        ),
+    ]
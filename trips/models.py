@@ -8,6 +8,7 @@ from typing import List, Optional
 import calendar
 import pandas as pd
 import uuid
+from django.db.models import F
 from django.db.models.aggregates import Sum
 from django.db.models.functions import Trunc
 from ranking import Ranking
@@ -16,6 +17,7 @@ import pytz
 from django.utils import timezone
 from django.db import transaction
 from django.contrib.gis.db import models
+from django.contrib.postgres.fields import ArrayField
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 from django_prometheus.models import ExportModelOperationsMixin
@@ -23,6 +25,7 @@ from modeltrans.fields import TranslationField
 
 from budget.enums import EmissionUnit, TimeResolution
 from trips_ingest.models import DeviceHeartbeat, Location
+from .device_cache import device_cache
 
 
 LOCAL_TZ = pytz.timezone(settings.TIME_ZONE)
@@ -46,6 +49,12 @@ class DeviceQuerySet(models.QuerySet):
     def by_name(self, name):
         return self.filter(friendly_name__iexact=name)
 
+    def enabled(self):
+        return self.filter(enabled_at__isnull=False)
+
+    def disabled(self):
+        return self.filter(enabled_at__isnull=True)
+
     def has_trips_during(self, start_date: date, end_date: date):
         start_time = LOCAL_TZ.localize(datetime.combine(start_date, time(0)))
         end_time = LOCAL_TZ.localize(datetime.combine(end_date + timedelta(days=1), time(0)))
@@ -98,14 +107,15 @@ class Device(ExportModelOperationsMixin('device'), models.Model):
                 dev.enabled_at = None
                 dev.disabled_at = time
             dev.save(update_fields=['enabled_at', 'disabled_at'])
+        self.enabled_at = dev.enabled_at
+        self.disabled_at = dev.disabled_at
+        device_cache.invalidate(self.uuid)
 
     @property
     def enabled(self):
-        try:
-            latest_event = self.enable_events.latest()
-            return latest_event.enabled
-        except EnableEvent.DoesNotExist:
-            return False
+        # enabled_at and disabled_at mirror the latest EnableEvent
+        # (see the check_device_enabled management command).
+        return self.enabled_at is not None
 
     def update_daily_carbon_footprint(
         self, start_time: datetime, end_time: datetime, default_emissions: EmissionBudgetLevel = None
@@ -153,7 +163,7 @@ class Device(ExportModelOperationsMixin('device'), models.Model):
         last_day = calendar.monthrange(start_date.year, start_date.month)[1]
         end_date = start_date.replace(day=last_day)
         date_filter = Q(daily_carbon_footprints__date__gte=start_date, daily_carbon_footprints__date__lte=end_date)
-        active_devs = Device.objects.filter(enabled_at__isnull=False)
+        active_devs = Device.objects.enabled()
         devs = active_devs.annotate(
             carbon_sum=Sum('daily_carbon_footprints__carbon_footprint', filter=date_filter)
         ).filter(carbon_sum__isnull=False).order_by('carbon_sum')
@@ -348,6 +358,36 @@ class EnableEvent(models.Model):
         get_latest_by = 'time'
 
 
+class DeviceProcessingStateQuerySet(models.QuerySet):
+    def with_new_samples(self):
+        qs = Q(last_sample_created_at__gt=F('last_processed_created_at'))
+        qs |= Q(last_processed_created_at__isnull=True)
+        return self.filter(last_sample_created_at__isnull=False).filter(qs)
+
+
+class DeviceProcessingState(models.Model):
+    """Watermarks for finding devices with samples not yet processed into trips.
+
+    Keyed by uuid because samples may arrive before the device is created.
+    """
+    uuid = models.UUIDField(unique=True)
+    # Updated by ingest whenever new samples are saved
+    last_sample_created_at = models.DateTimeField(null=True, db_index=True)
+    # Updated by the trip generator
+    last_processed_created_at = models.DateTimeField(null=True)
+    last_leg_end = models.DateTimeField(null=True)
+    # Checkpoint of the trajectory filter (calc.dragimm.FilterState) after
+    # the last processed sample
+    filter_state = models.JSONField(null=True)
+
+    objects = DeviceProcessingStateQuerySet.as_manager()
+
+    def __str__(self):
+        return '%s (sample created at %s, processed %s)' % (
+            self.uuid, self.last_sample_created_at, self.last_processed_created_at
+        )
+
+
 class TripQuerySet(models.QuerySet):
     def annotate_times(self):
         if getattr(self, '_times_annotated', False):
@@ -495,6 +535,16 @@ class Leg(models.Model):
     carbon_footprint = models.FloatField(help_text=_('Carbon footprint in g CO2e'))
     nr_passengers = models.IntegerField(null=True)
 
+    # The track of the leg in one row, so that it doesn't have to be built
+    # from the LegLocation rows. NULL for legs generated before it existed.
+    geometry = models.LineStringField(null=True, srid=4326)
+    # Milliseconds from the previous vertex of `geometry` (the first one
+    # from start_time)
+    location_time_deltas = ArrayField(models.IntegerField(), null=True)
+    simplification_error = models.FloatField(
+        null=True, help_text=_('Largest distance in m of a dropped sample from the stored track')
+    )
+
     received_at = models.DateTimeField(null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(null=True)
@@ -518,6 +568,17 @@ class Leg(models.Model):
     def can_user_update(self) -> bool:
         return timezone.now() < self.trip.get_update_end_time()
 
+    def get_location_times(self) -> Optional[List[datetime]]:
+        """Return the times of the vertices of `geometry`."""
+        if self.location_time_deltas is None:
+            return None
+        times = []
+        location_time = self.start_time
+        for delta in self.location_time_deltas:
+            location_time += timedelta(milliseconds=delta)
+            times.append(location_time)
+        return times
+
     def __str__(self):
         duration = (self.end_time - self.start_time).total_seconds() / 60
         deleted = 'DELETED ' if self.deleted_at else ''
@@ -5,7 +5,7 @@ from typing import Any
 import graphene
 import graphene_django_optimizer as gql_optimizer
 import sentry_sdk
-from django.contrib.gis.geos import LineString
+from django.contrib.gis.geos import LineString, Point
 from django.db import transaction
 from django.db.models import Q
 from django.utils import timezone
@@ -69,6 +69,8 @@ class LegNode(DjangoNode, AuthenticatedDeviceNode):
     def resolve_geometry(root: Leg, info):
         if not root.can_user_update():
             points = []
+        elif root.geometry is not None:
+            return root.geometry
         else:
             points = list(root.locations.active().values_list('loc', flat=True).order_by('time'))
         return LineString(points)
@@ -76,6 +78,11 @@ class LegNode(DjangoNode, AuthenticatedDeviceNode):
     def resolve_locations(root: Leg, info):
         if not root.can_user_update():
             points = []
+        elif root.geometry is not None and root.location_time_deltas is not None:
+            points = [
+                LegLocation(leg=root, loc=Point(coords, srid=root.geometry.srid), time=time)
+                for coords, time in zip(root.geometry.coords, root.get_location_times())
+            ]
         else:
             points = root.locations.active()
         return points
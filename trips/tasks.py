@@ -1,5 +1,6 @@
 import logging
 from celery import shared_task
+from django.conf import settings
 
 from .generate import TripGenerator
 
@@ -10,5 +11,18 @@ generator = TripGenerator()
 
 @shared_task
 def generate_new_trips():
+    if settings.GENERATE_TRIPS_IN_PARALLEL:
+        states = generator.find_devices_with_new_samples()
+        logger.info('Queuing trip generation for %d devices' % len(states))
+        for state in states:
+            generate_new_trips_for_device.delay(str(state.uuid))
+        return
+
     logger.info('Generating new trips')
     generator.generate_new_trips()
+
+
+@shared_task
+def generate_new_trips_for_device(uuid):
+    logger.info('Generating new trips for %s' % uuid)
+    generator.generate_new_trips_for_device(uuid)
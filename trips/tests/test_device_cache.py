@@ -0,0 +1,49 @@
+import pytest
+from django.core.exceptions import ValidationError
+
+from trips.device_cache import device_cache
+from trips.models import Device
+from trips.tests.factories import DeviceFactory
+
+pytestmark = pytest.mark.django_db
+
+
+def test_device_cache_get(django_assert_num_queries):
+    device = DeviceFactory()
+    cached = device_cache.get(device.uuid)
+    assert cached.id == device.id
+    assert cached.token == str(device.token)
+    assert cached.enabled
+    with django_assert_num_queries(0):
+        assert device_cache.get(str(device.uuid)) == cached
+
+
+def test_device_cache_not_found():
+    with pytest.raises(Device.DoesNotExist):
+        device_cache.get('00000000-0000-0000-0000-000000000000')
+    with pytest.raises(ValidationError):
+        device_cache.get('foo')
+
+
+def test_device_cache_invalidated_on_save():
+    device = DeviceFactory(brand='foo')
+    assert device_cache.get(device.uuid).brand == 'foo'
+    device.brand = 'bar'
+    device.save()
+    assert device_cache.get(device.uuid).brand == 'bar'
+
+
+def test_device_cache_invalidated_on_set_enabled():
+    device = DeviceFactory()
+    assert device_cache.get(device.uuid).enabled
+    device.set_enabled(False)
+    assert not device_cache.get(device.uuid).enabled
+
+
+def test_device_cache_invalidated_on_delete():
+    device = DeviceFactory()
+    uuid = device.uuid
+    device_cache.get(uuid)
+    device.delete()
+    with pytest.raises(Device.DoesNotExist):
+        device_cache.get(uuid)
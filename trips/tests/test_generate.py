@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+import pytest
+from datetime import datetime
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.db import connection
+from django.utils.timezone import make_aware, utc
+
+from analytics.models import TripSummary
+from feedback.models import DeviceFeedback
+from trips.generate import DELETE_OVERLAPPING_TRIPS_SQL, TripGenerator
+from trips.models import Leg, LegLocation, Trip, UserLegUpdate
+from trips.tests.factories import DeviceFactory, LegFactory, TransportModeFactory, TripFactory
+
+pytestmark = pytest.mark.django_db
+
+MIN_TIME = make_aware(datetime(2020, 1, 1, 11, 0), utc)
+MAX_TIME = make_aware(datetime(2020, 1, 1, 13, 0), utc)
+
+
+def delete_overlapping_trips(device, force=False):
+    with connection.cursor() as cursor:
+        cursor.execute(DELETE_OVERLAPPING_TRIPS_SQL, dict(
+            device_id=device.id, min_time=MIN_TIME, max_time=MAX_TIME, force=force,
+        ))
+        return cursor.fetchone()
+
+
+def create_trip(device, **leg_kwargs):
+    trip = TripFactory(device=device)
+    legs = [
+        LegFactory(trip=trip, **leg_kwargs),
+        LegFactory(
+            trip=trip, start_time=make_aware(datetime(2020, 1, 1, 12, 10), utc),
+            end_time=make_aware(datetime(2020, 1, 1, 12, 30), utc), **leg_kwargs
+        ),
+    ]
+    for leg in legs:
+        for time in (leg.start_time, leg.end_time):
+            LegLocation.objects.create(leg=leg, loc=Point(23.76, 61.50, srid=4326), time=time, speed=1.0)
+    return trip, legs
+
+
+def test_delete_overlapping_trips(device):
+    trip, legs = create_trip(device)
+    UserLegUpdate.objects.create(leg=legs[0], data={})
+    TripSummary.objects.create(
+        trip=trip, start_time=legs[0].start_time, end_time=legs[1].end_time, length=1000, carbon_footprint=0,
+        start_loc=Point(327000, 6820000, srid=settings.LOCAL_SRS),
+        end_loc=Point(328000, 6820000, srid=settings.LOCAL_SRS),
+    )
+    leg_feedback = DeviceFeedback.objects.create(device=device, trip=trip, leg=legs[0], comment='Wrong mode')
+    trip_feedback = DeviceFeedback.objects.create(device=device, trip=trip, comment='Missing leg')
+
+    legs_corrected, trips_corrected, *counts = delete_overlapping_trips(device, force=True)
+    assert legs_corrected and trips_corrected
+    assert counts == [1, 2, 4]
+    assert not Trip.objects.filter(id=trip.id).exists()
+    assert not Leg.objects.filter(trip_id=trip.id).exists()
+    assert not LegLocation.objects.filter(leg_id__in=[leg.id for leg in legs]).exists()
+    assert not UserLegUpdate.objects.exists()
+    assert not TripSummary.objects.exists()
+
+    leg_feedback.refresh_from_db()
+    trip_feedback.refresh_from_db()
+    assert leg_feedback.trip is None and leg_feedback.leg is None
+    assert trip_feedback.trip is None
+
+
+@pytest.mark.parametrize('correction', ['user_corrected_mode', 'leg_feedback', 'trip_feedback'])
+def test_delete_overlapping_trips_corrected(device, correction):
+    if correction == 'user_corrected_mode':
+        trip, legs = create_trip(device, user_corrected_mode=TransportModeFactory(identifier='walk'))
+    else:
+        trip, legs = create_trip(device)
+        leg = legs[0] if correction == 'leg_feedback' else None
+        DeviceFeedback.objects.create(device=device, trip=trip, leg=leg, comment='Feedback')
+
+    legs_corrected, trips_corrected, *counts = delete_overlapping_trips(device)
+    assert legs_corrected == (correction != 'trip_feedback')
+    assert trips_corrected == (correction != 'user_corrected_mode')
+    assert counts == [0, 0, 0]
+    assert Trip.objects.filter(id=trip.id).exists()
+    assert Leg.objects.filter(trip=trip).count() == 2
+    assert LegLocation.objects.filter(leg__trip=trip).count() == 4
+
+    delete_overlapping_trips(device, force=True)
+    assert not Trip.objects.filter(id=trip.id).exists()
+
+
+def test_delete_overlapping_trips_outside_range(device):
+    trip, legs = create_trip(device)
+    earlier_trip = TripFactory(device=device)
+    earlier_leg = LegFactory(
+        trip=earlier_trip, start_time=make_aware(datetime(2020, 1, 1, 9, 0), utc),
+        end_time=make_aware(datetime(2020, 1, 1, 10, 0), utc),
+    )
+    other_device_trip, other_device_legs = create_trip(DeviceFactory())
+
+    legs_corrected, trips_corrected, *counts = delete_overlapping_trips(device)
+    assert not legs_corrected and not trips_corrected
+    assert counts == [1, 2, 4]
+    assert not Trip.objects.filter(id=trip.id).exists()
+    assert Trip.objects.filter(id=earlier_trip.id).exists()
+    assert Leg.objects.filter(id=earlier_leg.id).exists()
+    assert Trip.objects.filter(id=other_device_trip.id).exists()
+    assert LegLocation.objects.filter(leg__trip=other_device_trip).count() == 4
+
+
+def test_insert_leg_locations(device):
+    for identifier in ('walk', 'car', 'bicycle', 'bus', 'tram', 'train'):
+        TransportModeFactory(identifier=identifier)
+    trip = TripFactory(device=device)
+    legs = [LegFactory(trip=trip), LegFactory(trip=trip)]
+    time = pd.Series(pd.date_range('2020-01-01 12:00:00.5', periods=4, freq='5s', tz='UTC'))
+    lon = np.array([23.76, 23.77, 23.78, 23.79])
+    lat = np.array([61.49, 61.50, 61.51, 61.52])
+
+    TripGenerator().insert_leg_locations(
+        leg_ids=np.array([legs[0].id, legs[0].id, legs[1].id, legs[1].id]), lon=lon, lat=lat,
+        time=time, speed=np.array([1.0, 2.0, 3.0, 4.0]),
+    )
+
+    locs = list(LegLocation.objects.order_by('time'))
+    assert [loc.leg_id for loc in locs] == [legs[0].id, legs[0].id, legs[1].id, legs[1].id]
+    assert [loc.time for loc in locs] == list(time)
+    assert [loc.speed for loc in locs] == [1.0, 2.0, 3.0, 4.0]
+    for loc, x, y in zip(locs, lon, lat):
+        assert loc.loc.srid == 4326
+        assert (loc.loc.x, loc.loc.y) == (x, y)
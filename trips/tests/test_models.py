@@ -1,5 +1,6 @@
 import pytest
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
+from uuid import UUID
 from django.utils.timezone import make_aware, utc
 
 from budget.tests.factories import DeviceDailyCarbonFootprintFactory, PrizeFactory
@@ -8,7 +9,7 @@ from trips.tests.factories import (
     BackgroundInfoQuestionFactory, DeviceDefaultModeVariantFactory, DeviceFactory, LegFactory, TripFactory
 )
 from trips.generate import make_point
-from trips.models import AlreadyRegistered, Device, MigrationRequired
+from trips.models import AlreadyRegistered, Device, DeviceProcessingState, Leg, MigrationRequired
 from trips_ingest.models import DeviceHeartbeat, Location
 
 pytestmark = pytest.mark.django_db
@@ -196,3 +197,40 @@ def test_device_register_moves_prize(registered_device):
     new_device.register(registered_device.account_key)
     assert not registered_device.prizes.exists()
     assert list(new_device.prizes.all()) == [prize]
+
+
+def test_device_enabled_without_queries(django_assert_num_queries):
+    device = DeviceFactory()
+    with django_assert_num_queries(0):
+        assert device.enabled
+    device.set_enabled(False)
+    with django_assert_num_queries(0):
+        assert not device.enabled
+    assert not Device.objects.enabled().filter(id=device.id).exists()
+    assert Device.objects.disabled().filter(id=device.id).exists()
+
+
+def test_device_processing_state_with_new_samples():
+    t1 = make_aware(datetime(2020, 1, 1, 12, 0), utc)
+    t2 = make_aware(datetime(2020, 1, 1, 13, 0), utc)
+    new = DeviceProcessingState.objects.create(uuid=UUID(int=1), last_sample_created_at=t2)
+    updated = DeviceProcessingState.objects.create(
+        uuid=UUID(int=2), last_sample_created_at=t2, last_processed_created_at=t1
+    )
+    DeviceProcessingState.objects.create(uuid=UUID(int=3), last_sample_created_at=t1, last_processed_created_at=t1)
+    DeviceProcessingState.objects.create(uuid=UUID(int=4), last_leg_end=t1)
+    assert set(DeviceProcessingState.objects.with_new_samples()) == {new, updated}
+
+
+def test_leg_get_location_times():
+    start_time = make_aware(datetime(2020, 1, 1, 12, 0), utc)
+    leg = Leg(start_time=start_time, location_time_deltas=[0, 1500, 250, 60000])
+    assert leg.get_location_times() == [
+        start_time,
+        start_time + timedelta(milliseconds=1500),
+        start_time + timedelta(milliseconds=1750),
+        start_time + timedelta(milliseconds=61750),
+    ]
+
+    leg.location_time_deltas = None
+    assert leg.get_location_times() is None
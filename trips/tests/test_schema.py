@@ -209,6 +209,7 @@ def test_device_directive_invalid_token(graphql_client_query, contains_error, uu
 def test_device_directive_mocaf_disabled(graphql_client_query, disable_mocaf, contains_error, uuid, token, trip):
     assert trip.device
     disable_mocaf(uuid, token)
+    trip.device.refresh_from_db()
     assert not trip.device.enabled
     response = graphql_client_query(
         '''
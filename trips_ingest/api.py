@@ -1,18 +1,25 @@
 import json
 import logging
 
+import orjson
 import sentry_sdk
+from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 from django.urls import reverse
 from rest_framework.decorators import api_view, schema
+from rest_framework.exceptions import ParseError
 from django.http import HttpResponse
 from rest_framework.response import Response
 
+from trips.device_cache import device_cache
 from trips.models import Device
 from .models import ReceiveData, ReceiveDebugLog
+from .processor import EventProcessor, InvalidEventError
 
 
 logger = logging.getLogger(__name__)
+processor = EventProcessor()
 
 
 def modify_for_debug_logs(request, data, resp):
@@ -35,15 +42,15 @@ def modify_for_debug_logs(request, data, resp):
             return
 
     try:
-        dev = Device.objects.get(uuid=uid)
+        dev = device_cache.get(uid)
     except Exception:
         return
 
     c = []
     if dev.debug_log_level or dev.custom_config:
         if not dev.debugging_enabled_at:
-            dev.debugging_enabled_at = timezone.now()
-            dev.save(update_fields=['debugging_enabled_at'])
+            Device.objects.filter(id=dev.id).update(debugging_enabled_at=timezone.now())
+            device_cache.invalidate(dev.uuid)
             logger.info('Enabling debug logs or custom config for %s' % uid)
 
         default_config = {
@@ -59,7 +66,8 @@ def modify_for_debug_logs(request, data, resp):
         }
 
         if dev.custom_config and isinstance(dev.custom_config, dict):
-            config = dev.custom_config
+            # Copy so that the cached config is not modified
+            config = dict(dev.custom_config)
         else:
             config = default_config
 
@@ -76,25 +84,57 @@ def modify_for_debug_logs(request, data, resp):
         if dev.debugging_enabled_at:
             c.append(['setConfig', {'logLevel': 0}])
             c.append(['destroyLog'])
-            dev.debugging_enabled_at = None
-            dev.save(update_fields=['debugging_enabled_at'])
+            Device.objects.filter(id=dev.id).update(debugging_enabled_at=None)
+            device_cache.invalidate(dev.uuid)
 
     if c:
         resp.clear()
         resp['background_geolocation'] = c
 
 
+def ingest_locations_directly(obj):
+    """Save the location samples of a received event right away.
+
+    The event is still stored as ReceiveData so that it can be replayed later.
+    If the import fails unexpectedly, the event is left for the background
+    import task.
+    """
+    try:
+        with transaction.atomic():
+            processor.process_location_event(obj)
+    except InvalidEventError as e:
+        logger.info(e)
+        obj.import_failed = True
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        return
+    else:
+        obj.import_failed = False
+    obj.imported_at = timezone.now()
+
+
 @api_view(['POST'])
 @schema(None)
 def ingest_view(request):
     received_at = timezone.now()
-    data = request.data
+    if settings.INGEST_LOCATIONS_DIRECTLY:
+        try:
+            data = orjson.loads(request.body)
+        except orjson.JSONDecodeError:
+            raise ParseError()
+    else:
+        data = request.data
     obj = ReceiveData(data=data, received_at=received_at)
     try:
-        obj.device = Device.objects.get(uuid=obj.get_uuid())
+        obj.device_id = device_cache.get(obj.get_uuid()).id
     except Exception as e:
         sentry_sdk.capture_exception(e)
-    obj.save()
+    # The samples and the event marked as imported are saved together, so
+    # that the event is not imported again if saving it fails.
+    with transaction.atomic():
+        if settings.INGEST_LOCATIONS_DIRECTLY and isinstance(data, dict) and obj.get_event_type() == 'location':
+            ingest_locations_directly(obj)
+        obj.save()
 
     resp = {'ok': True, 'received_at': received_at}
     modify_for_debug_logs(request, data, resp)
@@ -0,0 +1,39 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from calc.trips import annotate_location_ways
+from trips.models import Device
+from trips_ingest.models import Location
+
+
+class Command(BaseCommand):
+    help = 'Store the nearest car and rail ways of the location samples that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uuid', type=str, help='Only annotate the samples of this device')
+        parser.add_argument(
+            '--reset', action='store_true',
+            help='Recompute the nearest ways of all the samples, e.g. after the OSM views have been refreshed'
+        )
+
+    def handle(self, *args, **options):
+        if options['uuid']:
+            uuids = [options['uuid']]
+        else:
+            uuids = list(Device.objects.order_by('uuid').values_list('uuid', flat=True))
+
+        start_time = datetime(2010, 1, 1, tzinfo=timezone.utc)
+        total = 0
+        for uid in uuids:
+            # One transaction per device keeps the row locks short
+            with transaction.atomic():
+                if options['reset']:
+                    Location.objects.filter(uuid=uid).update(closest_ways_updated_at=None)
+                count = annotate_location_ways(connection, str(uid), start_time, timezone.now())
+            if count:
+                self.stdout.write('%s: %d samples annotated' % (uid, count))
+            total += count
+        self.stdout.write('Annotated %d samples' % total)
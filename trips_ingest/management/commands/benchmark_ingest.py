@@ -0,0 +1,85 @@
+import random
+import uuid
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from trips_ingest.models import Location, ReceiveData
+from trips_ingest.processor import DUPLICATE_WINDOW, EventProcessor
+from utils.perf import PerfCounter
+
+
+# Default for the maxBatchSize setting of the mobile app
+DEFAULT_SAMPLES = 500
+
+
+def make_location_event(uid, nr_samples, start_time):
+    locs = []
+    lat, lon = 61.4978, 23.7610
+    for i in range(nr_samples):
+        lat += random.uniform(-0.0001, 0.0001)
+        lon += random.uniform(-0.0001, 0.0001)
+        locs.append({
+            'timestamp': (start_time + timedelta(seconds=i * 5)).isoformat(),
+            'is_moving': True,
+            'odometer': i * 50.0,
+            'activity': {'type': 'in_vehicle', 'confidence': 80},
+            'coords': {
+                'latitude': lat, 'longitude': lon, 'accuracy': 10.0, 'speed': 10.0,
+                'heading': 90.0, 'altitude': 100.0,
+            },
+            'battery': {'is_charging': False},
+            'extras': {'uid': str(uid)},
+        })
+    return ReceiveData(data={'location': locs}, received_at=timezone.now())
+
+
+class Command(BaseCommand):
+    help = 'Benchmark duplicate detection and saving of location uploads (nothing is saved)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES, help='Samples per upload')
+        parser.add_argument('--rounds', type=int, default=5, help='How many uploads to process')
+
+    def per_sample_duplicate_check(self, objs):
+        # The original implementation: one query per sample
+        for obj in objs:
+            Location.objects.filter(
+                time__gte=obj.time - DUPLICATE_WINDOW, time__lte=obj.time + DUPLICATE_WINDOW,
+                uuid=obj.uuid
+            ).exists()
+
+    def handle(self, *args, **options):
+        processor = EventProcessor()
+        nr_samples = options['samples']
+        uid = uuid.uuid4()
+        start_time = timezone.now() - timedelta(days=1)
+
+        totals = {}
+
+        def measure(name, pc):
+            totals[name] = totals.get(name, 0) + pc.measure()
+
+        with transaction.atomic():
+            for i in range(options['rounds']):
+                event = make_location_event(uid, nr_samples, start_time + timedelta(hours=i))
+                pc = PerfCounter('benchmark')
+                objs = processor.parse_location_samples(event)
+                measure('parse', pc)
+                self.per_sample_duplicate_check(objs)
+                measure('per-sample duplicate check', pc)
+                new_objs = processor.filter_duplicate_locations(objs)
+                measure('set-based duplicate check', pc)
+                processor.insert_locations(new_objs)
+                measure('insert', pc)
+                # Re-uploading the same samples should be detected as duplicates
+                assert not processor.filter_duplicate_locations(objs)
+                measure('set-based duplicate check (all duplicates)', pc)
+            transaction.set_rollback(True)
+
+        rounds = options['rounds']
+        self.stdout.write('%d uploads of %d samples' % (rounds, nr_samples))
+        for name, total in totals.items():
+            self.stdout.write('%-45s %8.1f ms / upload' % (name, total / rounds))
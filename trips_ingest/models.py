@@ -178,6 +178,12 @@ class Location(models.Model):
     manual_atype = models.CharField(choices=ActivityTypeChoices.choices, null=True, max_length=20)
     sensor_data_count = models.PositiveIntegerField(null=True)
     deleted_at = models.DateTimeField(null=True)
+    # Nearest OSM ways within 50 m, stored when the samples are saved
+    closest_car_way_id = models.BigIntegerField(null=True)
+    closest_car_way_dist = models.FloatField(null=True)
+    closest_rail_way_id = models.BigIntegerField(null=True)
+    closest_rail_way_dist = models.FloatField(null=True)
+    closest_ways_updated_at = models.DateTimeField(null=True)
 
     class Meta:
         managed = False
@@ -3,14 +3,18 @@ import pytz
 from datetime import datetime, timedelta
 import logging
 
+import numpy as np
 from dateutil.parser import isoparse
 import sentry_sdk
-from django.db import transaction, IntegrityError
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Case, Q, Value, When
 from django.utils import timezone
 from django.contrib.gis.geos import Point
-from django.contrib.gis.gdal import SpatialReference, CoordTransform
+from psycopg2.extras import execute_values
 from calc.trips import LOCAL_2D_CRS
-from trips.models import Device
+from utils.geo import transform_coords, valid_local_coords
+from trips.device_cache import device_cache
+from trips.models import Device, DeviceProcessingState
 from .models import ReceiveData, Location, DeviceHeartbeat, ActivityTypeChoices, SensorSample
 
 
@@ -18,9 +22,17 @@ logger = logging.getLogger(__name__)
 
 ACTIVITY_TYPES = set([x.value for x in list(ActivityTypeChoices)])
 
-LOCAL_CRS = SpatialReference(LOCAL_2D_CRS)
-GPS_CRS = SpatialReference(4326)
-coord_transform = CoordTransform(GPS_CRS, LOCAL_CRS)
+GPS_SRID = 4326
+
+LOCATION_TABLE = Location._meta.db_table
+PROCESSING_STATE_TABLE = DeviceProcessingState._meta.db_table
+
+# Samples closer than this to an existing sample of the same device are
+# considered duplicates.
+DUPLICATE_WINDOW = timedelta(seconds=0.5)
+
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+ONE_US = timedelta(microseconds=1)
 
 
 def null_float(val):
@@ -41,6 +53,38 @@ def uuid_or_bye(val):
     return uid
 
 
+def datetimes_to_us(dts):
+    return np.array([(dt - EPOCH) // ONE_US for dt in dts], dtype=np.int64)
+
+
+def find_duplicate_times(times, existing_times, window=DUPLICATE_WINDOW):
+    """Return a boolean mask of the sample times that are duplicates.
+
+    A sample is a duplicate if it is within `window` of an existing sample
+    or of an earlier accepted sample in `times`. Times are given as
+    microseconds; `existing_times` does not need to be sorted.
+    """
+    window = window // ONE_US
+    existing_times = np.sort(existing_times)
+    mask = np.zeros(len(times), dtype=bool)
+    if len(existing_times):
+        idx = np.searchsorted(existing_times, times - window, side='left')
+        found = idx < len(existing_times)
+        mask[found] = existing_times[idx[found]] <= times[found] + window
+
+    # Samples within the upload itself might also overlap
+    last_accepted = None
+    for i in np.argsort(times, kind='stable'):
+        if mask[i]:
+            continue
+        if last_accepted is not None and times[i] - last_accepted <= window:
+            mask[i] = True
+            continue
+        last_accepted = times[i]
+
+    return mask
+
+
 def sane_time_or_bye(dt):
     now = timezone.now()
     if dt < now - timedelta(days=7):
@@ -59,13 +103,15 @@ class EventProcessor:
         event.imported_at = timezone.now()
         event.save(update_fields=['import_failed', 'imported_at'])
 
-    def process_location_event(self, event):
+    def parse_location_samples(self, event):
         locs = event.data.get('location')
         if not isinstance(locs, list):
             raise InvalidEventError("location missing or invalid")
 
         DICT_KEYS = ['activity', 'coords', 'extras']
-        last_uuid = None
+        objs = []
+        lons = []
+        lats = []
         for loc in locs:
             for key in DICT_KEYS:
                 if not isinstance(loc.get(key), dict):
@@ -87,15 +133,6 @@ class EventProcessor:
             obj.time = sane_time_or_bye(dt)
             obj.uuid = uuid_or_bye(event.data.get('uid') or loc['extras'].get('uid'))
 
-            if Location.objects.filter(
-                time__gte=obj.time - timedelta(seconds=0.5), time__lte=obj.time + timedelta(seconds=0.5),
-                uuid=obj.uuid
-            ).exists():
-                logger.warning('Location for %s at %s already exists' % (obj.uuid, obj.time))
-                return
-
-            last_uuid = obj.uuid
-
             atype = loc['activity'].get('type')
             if atype not in ACTIVITY_TYPES:
                 raise InvalidEventError("invalid activity type")
@@ -113,32 +150,160 @@ class EventProcessor:
             obj.speed_error = null_float(loc['coords'].get('speed_accuracy'))
             obj.odometer = null_float(loc.get('odometer'))
             obj.loc_error = null_float(loc['coords'].get('accuracy'))
-
-            point = Point(loc['coords']['longitude'], loc['coords']['latitude'], srid=LOCAL_2D_CRS)
-            point.transform(coord_transform)
-            if point.x <= 0 or point.y <= 0:
-                raise InvalidEventError("invalid coords")
-            obj.loc = point
+            lons.append(loc['coords']['longitude'])
+            lats.append(loc['coords']['latitude'])
 
             obj.debug = bool(event.data.get('debug') or loc['extras'].get('debug', 0))
             obj.is_moving = loc.get('is_moving')
             obj.battery_charging = loc.get('battery', {}).get('is_charging')
-            obj.save(force_insert=True)
+            objs.append(obj)
 
-        logger.info('%d location samples saved for %s' % (len(locs), last_uuid))
+        # Transform all the coordinates of the event in one go
+        try:
+            xs, ys = transform_coords(lons, lats, GPS_SRID, LOCAL_2D_CRS)
+        except (TypeError, ValueError):
+            raise InvalidEventError("invalid coords")
+        if not valid_local_coords(xs, ys).all():
+            raise InvalidEventError("invalid coords")
+        for obj, x, y in zip(objs, xs, ys):
+            obj.loc = Point(float(x), float(y), srid=LOCAL_2D_CRS)
+
+        return objs
+
+    def process_location_event(self, event):
+        objs = self.filter_duplicate_locations(self.parse_location_samples(event))
+        self.insert_locations(objs)
+        uuids = set(obj.uuid for obj in objs)
+        logger.info('%d location samples saved for %s' % (len(objs), ', '.join(str(x) for x in uuids)))
+
+    def filter_duplicate_locations(self, objs):
+        """Drop samples that already exist in the DB or earlier in the list.
+
+        Existing timestamps are fetched with a single query spanning the
+        time range of the samples of each device; the duplicate window is
+        then matched in memory.
+        """
+        if not objs:
+            return []
+
+        objs_by_uuid = {}
+        for obj in objs:
+            objs_by_uuid.setdefault(obj.uuid, []).append(obj)
+
+        time_ranges = Q()
+        for uid, uuid_objs in objs_by_uuid.items():
+            times = [obj.time for obj in uuid_objs]
+            time_ranges |= Q(
+                uuid=uid, time__gte=min(times) - DUPLICATE_WINDOW, time__lte=max(times) + DUPLICATE_WINDOW
+            )
+        existing = Location.objects.filter(time_ranges).values_list('uuid', 'time')
+        existing_by_uuid = {}
+        for uid, time in existing:
+            existing_by_uuid.setdefault(uid, []).append(time)
+
+        is_duplicate = set()
+        for uid, uuid_objs in objs_by_uuid.items():
+            mask = find_duplicate_times(
+                datetimes_to_us([obj.time for obj in uuid_objs]),
+                datetimes_to_us(existing_by_uuid.get(uid, [])),
+            )
+            for obj in [obj for obj, dup in zip(uuid_objs, mask) if dup]:
+                logger.warning('Location for %s at %s already exists' % (obj.uuid, obj.time))
+                is_duplicate.add(id(obj))
+
+        return [obj for obj in objs if id(obj) not in is_duplicate]
+
+    def insert_locations(self, objs):
+        # The nearest car and rail ways (within 50 m) are stored with the
+        # samples, so that reading them for trip generation is a plain range
+        # scan. Run the annotate_location_ways management command with --reset
+        # to recompute them after refreshing the OSM views.
+        query = f'''INSERT INTO {LOCATION_TABLE} (
+            time, uuid, loc, loc_error, atype, aconf, speed, speed_error, altitude,
+            heading, heading_error, odometer, is_moving, battery_charging, created_at, debug,
+            closest_car_way_id, closest_car_way_dist, closest_rail_way_id, closest_rail_way_dist,
+            closest_ways_updated_at
+        )
+        SELECT
+            v.*,
+            ccw.osm_id, ST_Distance(ccw.way, v.loc), crw.osm_id, ST_Distance(crw.way, v.loc), NOW()
+        FROM (VALUES %s) AS v (
+            time, uuid, loc, loc_error, atype, aconf, speed, speed_error, altitude,
+            heading, heading_error, odometer, is_moving, battery_charging, created_at, debug
+        )
+        LEFT JOIN LATERAL (
+            SELECT osm_id, way FROM planet_osm_car_ways AS cw
+            WHERE cw.way && ST_Expand(v.loc, 50)
+            ORDER BY cw.way <-> v.loc
+            LIMIT 1
+        ) AS ccw ON true
+        LEFT JOIN LATERAL (
+            SELECT osm_id, way FROM planet_osm_rail_ways AS rw
+            WHERE rw.way && ST_Expand(v.loc, 50)
+            ORDER BY rw.way <-> v.loc
+            LIMIT 1
+        ) AS crw ON true
+        ON CONFLICT (time, uuid) DO NOTHING'''
+        # The columns of VALUES in a subquery need explicit types
+        value_template = f"""(
+            %s::timestamptz, %s::uuid, ST_SetSRID(ST_MakePoint(%s, %s), {LOCAL_2D_CRS}), %s::float8,
+            %s::varchar, %s::float8, %s::float8, %s::float8, %s::float8, %s::float8, %s::float8, %s::float8,
+            %s::boolean, %s::boolean, %s::timestamptz, %s::boolean
+        )"""
+        rows = [(
+            obj.time, str(obj.uuid), obj.loc.x, obj.loc.y, obj.loc_error, obj.atype, obj.aconf, obj.speed,
+            obj.speed_error, obj.altitude, obj.heading, obj.heading_error, obj.odometer, obj.is_moving,
+            obj.battery_charging, obj.created_at, obj.debug
+        ) for obj in objs]
+
+        with connection.cursor() as cursor:
+            execute_values(cursor, query, rows, template=value_template, page_size=1000)
+
+        self.update_sample_watermarks(objs)
+
+    def update_sample_watermarks(self, objs):
+        # Let the trip generator know which devices have new samples
+        latest_by_uuid = {}
+        for obj in objs:
+            latest = latest_by_uuid.get(obj.uuid)
+            if latest is None or obj.created_at > latest:
+                latest_by_uuid[obj.uuid] = obj.created_at
+        if not latest_by_uuid:
+            return
+
+        query = f'''INSERT INTO {PROCESSING_STATE_TABLE} AS s (uuid, last_sample_created_at) VALUES %s
+        ON CONFLICT (uuid) DO UPDATE SET last_sample_created_at = GREATEST(
+            s.last_sample_created_at, EXCLUDED.last_sample_created_at
+        )'''
+        rows = sorted((str(uid), created_at) for uid, created_at in latest_by_uuid.items())
+        with connection.cursor() as cursor:
+            execute_values(cursor, query, rows)
 
     def process_device_info_event(self, event):
         data = event.data
 
         uid = uuid_or_bye(data.get('userId'))
+        info = dict(
+            brand=data.get('brand'),
+            model=data.get('model'),
+            platform=data.get('os'),
+            system_version=data.get('systemVersion'),
+        )
+
+        try:
+            cached_dev = device_cache.get(uid)
+        except Device.DoesNotExist:
+            pass
+        else:
+            if all(getattr(cached_dev, key) == val for key, val in info.items()):
+                # Nothing changed
+                return
 
         dev = Device.objects.filter(uuid=uid).first()
         if dev is None:
             dev = Device(uuid=uid)
-        dev.brand = data.get('brand')
-        dev.model = data.get('model')
-        dev.platform = data.get('os')
-        dev.system_version = data.get('systemVersion')
+        for key, val in info.items():
+            setattr(dev, key, val)
         dev.save()
 
     def process_heartbeat_event(self, event):
@@ -198,25 +363,101 @@ class EventProcessor:
         else:
             raise InvalidEventError("unknown data type: %s" % data_type)
 
+    def process_single_event(self, event):
+        with sentry_sdk.configure_scope() as scope:
+            scope.set_tag('event-id', int(event.id))
+            scope.set_tag('event-received-at', str(event.received_at))
+
+            with transaction.atomic():
+                try:
+                    with transaction.atomic():
+                        try:
+                            self.process_event(event)
+                        except InvalidEventError as e:
+                            logger.info(e)
+                            raise
+                        except Exception as e:
+                            sentry_sdk.capture_exception(e)
+                            raise
+                except Exception:
+                    self.mark_imported(event, failed=True)
+                else:
+                    self.mark_imported(event, failed=False)
+
     def process_events(self):
         events = ReceiveData.objects.filter(imported_at__isnull=True).order_by('received_at')
         for event in events:
-            with sentry_sdk.configure_scope() as scope:
-                scope.set_tag('event-id', int(event.id))
-                scope.set_tag('event-received-at', str(event.received_at))
-
-                with transaction.atomic():
-                    try:
-                        with transaction.atomic():
-                            try:
-                                self.process_event(event)
-                            except InvalidEventError as e:
-                                logger.info(e)
-                                raise
-                            except Exception as e:
-                                sentry_sdk.capture_exception(e)
-                                raise
-                    except Exception:
-                        self.mark_imported(event, failed=True)
-                    else:
-                        self.mark_imported(event, failed=False)
+            self.process_single_event(event)
+
+    def process_event_batch(self, events):
+        """Import a batch of claimed events.
+
+        Location samples from all events are de-duplicated and inserted in bulk,
+        other event types are processed one by one. A malformed event is only
+        marked as failed; it does not abort the rest of the batch.
+        """
+        failed_ids = set()
+        location_events = []
+        location_objs = []
+        for event in events:
+            if event.get_event_type() != 'location':
+                try:
+                    with transaction.atomic():
+                        self.process_event(event)
+                except InvalidEventError as e:
+                    logger.info(e)
+                    failed_ids.add(event.id)
+                except Exception as e:
+                    sentry_sdk.capture_exception(e)
+                    failed_ids.add(event.id)
+                continue
+
+            try:
+                objs = self.parse_location_samples(event)
+            except InvalidEventError as e:
+                logger.info('Event %d: %s' % (event.id, e))
+                failed_ids.add(event.id)
+                continue
+            except Exception as e:
+                with sentry_sdk.configure_scope() as scope:
+                    scope.set_tag('event-id', int(event.id))
+                    scope.set_tag('event-received-at', str(event.received_at))
+                    sentry_sdk.capture_exception(e)
+                failed_ids.add(event.id)
+                continue
+            location_events.append(event)
+            location_objs += objs
+
+        try:
+            with transaction.atomic():
+                objs = self.filter_duplicate_locations(location_objs)
+                self.insert_locations(objs)
+        except Exception as e:
+            # Fall back to importing the location events one by one
+            # so that the offending event can be isolated.
+            sentry_sdk.capture_exception(e)
+            for event in location_events:
+                self.process_single_event(event)
+            processed_ids = set(ev.id for ev in location_events)
+            events = [ev for ev in events if ev.id not in processed_ids]
+        else:
+            logger.info('%d location samples saved from %d events' % (len(objs), len(location_events)))
+
+        if not events:
+            return
+
+        ReceiveData.objects.filter(id__in=[ev.id for ev in events]).update(
+            imported_at=timezone.now(),
+            import_failed=Case(When(id__in=failed_ids, then=Value(True)), default=Value(False)),
+        )
+
+    def process_events_batched(self, batch_size):
+        while True:
+            with transaction.atomic():
+                events = list(
+                    ReceiveData.objects.filter(imported_at__isnull=True).order_by('received_at')
+                    .select_for_update(skip_locked=True)[:batch_size]
+                )
+                if not events:
+                    break
+                self.process_event_batch(events)
@@ -1,6 +1,7 @@
 from datetime import timedelta
 import logging
 from celery import shared_task
+from django.conf import settings
 from django.utils import timezone
 
 from .processor import EventProcessor
@@ -14,7 +15,10 @@ processor = EventProcessor()
 @shared_task
 def ingest_events():
     logger.info('Processing events')
-    processor.process_events()
+    if settings.INGEST_BATCH_SIZE:
+        processor.process_events_batched(settings.INGEST_BATCH_SIZE)
+    else:
+        processor.process_events()
 
 
 @shared_task
@@ -0,0 +1,39 @@
+import numpy as np
+
+from trips_ingest.processor import find_duplicate_times
+
+
+def us(*seconds):
+    return (np.array(seconds, dtype=np.float64) * 1000000).astype(np.int64)
+
+
+def test_find_duplicate_times_no_existing_rows():
+    mask = find_duplicate_times(us(0, 1, 2), us())
+    assert list(mask) == [False, False, False]
+
+
+def test_find_duplicate_times_existing_rows():
+    # The window is 0.5 s in both directions and inclusive
+    times = us(9.4, 9.5, 10.0, 10.5, 10.6, 20.0)
+    mask = find_duplicate_times(times, us(10))
+    assert list(mask) == [False, True, True, True, False, False]
+
+
+def test_find_duplicate_times_unsorted_existing_rows():
+    times = us(1, 5, 10, 15)
+    mask = find_duplicate_times(times, us(15.2, 1.3, 30, 9.9))
+    assert list(mask) == [True, False, True, True]
+
+
+def test_find_duplicate_times_within_upload():
+    # The first of overlapping samples is kept, also when they arrive out of order
+    times = us(10.3, 10.0, 12.0, 12.5, 13.1)
+    mask = find_duplicate_times(times, us())
+    assert list(mask) == [True, False, False, True, False]
+
+
+def test_find_duplicate_times_within_upload_and_existing():
+    # A sample dropped as a duplicate of an existing row doesn't shadow the next one
+    times = us(10.2, 10.6, 10.9)
+    mask = find_duplicate_times(times, us(10))
+    assert list(mask) == [True, False, True]
@@ -0,0 +1,40 @@
+import threading
+
+import numpy as np
+from pyproj import Transformer
+
+
+# pyproj Transformers are not thread-safe, so keep one set per thread.
+transformer_data = threading.local()
+
+
+def get_transformer(from_srid, to_srid):
+    if not hasattr(transformer_data, 'transformers'):
+        transformer_data.transformers = {}
+    key = (from_srid, to_srid)
+    transformer = transformer_data.transformers.get(key)
+    if transformer is None:
+        # Always use (x, y) == (lon, lat) axis order like GEOS does
+        transformer = Transformer.from_crs(from_srid, to_srid, always_xy=True)
+        transformer_data.transformers[key] = transformer
+    return transformer
+
+
+def transform_coords(x, y, from_srid, to_srid):
+    """Transform arrays of coordinates from one SRS to another in one call.
+
+    Returns a tuple of float64 arrays (x, y). Coordinates that cannot be
+    transformed come back as inf.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if not len(x):
+        return x, y
+    transformer = get_transformer(from_srid, to_srid)
+    out_x, out_y = transformer.transform(x, y)
+    return np.asarray(out_x, dtype=np.float64), np.asarray(out_y, dtype=np.float64)
+
+
+def valid_local_coords(x, y):
+    """Return a boolean mask of coordinates that are sane in the local 2D SRS."""
+    return np.isfinite(x) & np.isfinite(y) & (x > 0) & (y > 0)